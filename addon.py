@@ -17,10 +17,26 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
 import xbmcvfs  # FIXME: Import form xbmcswift if fixed upstream
 from xbmcswift2 import Plugin, xbmcgui, NotFoundException, xbmc
-from resources.lib.api import JamendoApi, ApiError, ConnectionError
+from resources.lib.api import JamendoApi, ApiError, ConnectionError, \
+    NotModified, RATE_LIMIT, RATE_BURST
+from resources.lib.cache import ResponseCache, StreamUrlCache
+from resources.lib.circuit import CircuitBreaker
+from resources.lib.entities import EntityStore, ENDPOINT_KINDS, make_refs
+from resources.lib.jobs import DownloadQueue, FAILED
+from resources.lib.history import PlayHistory, PendingPlays
+from resources.lib.library import StorageLibrary, SqliteLibrary, \
+    normalize_downloaded_tracks, normalize_downloaded_albums
 from resources.lib.geolocate import get_location, QuotaReached
+from resources.lib.throttle import SharedTokenBucket
 from resources.lib.downloader import JamendoDownloader
 
 
@@ -48,6 +64,7 @@ STRINGS = {
     'show_user_playlists': 30019,
     'show_near_artists': 30020,
     'show_downloaded_albums': 30021,
+    'show_download_queue': 30022,
     # Misc strings
     'page': 30025,
     'language': 30026,
@@ -62,6 +79,8 @@ STRINGS = {
     'addon_settings': 30035,
     'download_track': 30036,
     'download_album': 30037,
+    'queue_download_track': 30038,
+    'queue_download_album': 30039,
     # Dialogs
     'search_heading_album': 30040,
     'search_heading_artist': 30041,
@@ -121,7 +140,33 @@ STRINGS = {
     'tag_type_genres': 30121,
     'tag_type_instruments': 30122,
     'tag_type_moods': 30123,
+    # Cache
+    'cache_stats_head': 30130,
+    'cache_entries_s_size_s': 30131,
+    'cache_hits_s_misses_s': 30132,
+    'cache_evictions_s': 30133,
+    'cache_cleared': 30134,
+    'cache_stale_hits_s': 30135,
+    'cache_revalidations_s': 30136,
+    'cache_entities_s': 30137,
+    # Download queue
+    'retry_download': 30140,
+    'remove_download': 30141,
+    'job_state_queued': 30142,
+    'job_state_running': 30143,
+    'job_state_done': 30144,
+    'job_state_failed': 30145,
+    'download_queued': 30146,
+    'already_queued': 30147,
+    'download_queue_empty': 30148,
+    'mixtape_exists': 30149,
 }
+DOWNLOAD_VERIFY_INTERVAL = 60 * 60  # seconds
+PREFETCH_WORKERS = 1  # shared by all plugin invocations
+PREFETCH_DELAY = 1  # seconds
+PREFETCH_TIMEOUT = 60  # seconds after which a taken slot is considered dead
+PLAY_TRACK_RE = re.compile(r'/play/track/([^/?]+)')
+NUMERIC_ID_RE = re.compile(r'\d+\Z')
 
 
 class Plugin_patched(Plugin):
@@ -145,6 +190,10 @@ class Plugin_patched(Plugin):
 
 
 plugin = Plugin_patched()
+entity_store = EntityStore(os.path.join(plugin.storage_path, 'entities.db'))
+stream_url_cache = StreamUrlCache(os.path.join(
+    xbmc.translatePath(plugin.addon.getAddonInfo('profile')), 'streams.db'
+))
 api = JamendoApi(
     client_id='de0f381a',
     limit=plugin.get_setting('limit', int),
@@ -152,6 +201,63 @@ api = JamendoApi(
         'image_size',
         choices=('big', 'medium', 'small')
     ),
+    pool_size=plugin.get_setting('connection_pool_size', int),
+    timeout=plugin.get_setting('request_timeout', int),
+    entity_store=entity_store,
+    retries=plugin.get_setting('request_retries', int),
+    circuit_breaker=CircuitBreaker(
+        os.path.join(plugin.storage_path, 'circuit.json')
+    ),
+    stream_url_cache=stream_url_cache,
+    # prefetch, revalidation and resolving ahead share their budget with
+    # the other plugin invocations and the service, the view's own
+    # requests are only limited within this invocation
+    background_rate_limiter=SharedTokenBucket(
+        os.path.join(
+            xbmc.translatePath(plugin.addon.getAddonInfo('profile')),
+            'throttle.db'
+        ),
+        RATE_LIMIT,
+        RATE_BURST
+    ),
+)
+download_queue = DownloadQueue(os.path.join(
+    xbmc.translatePath(plugin.addon.getAddonInfo('profile')), 'jobs.db'
+))
+library = StorageLibrary(
+    get_storage=plugin.get_storage,
+    history=PlayHistory(
+        os.path.join(plugin.storage_path, 'history.journal'),
+        limit=plugin.get_setting('history_limit', int)
+    ),
+    entity_store=entity_store,
+)
+library_db = os.path.join(plugin.storage_path, 'library.db')
+if plugin.get_setting('library_backend', choices=('storage', 'sqlite')) \
+        == 'sqlite':
+    library = SqliteLibrary(
+        library_db,
+        history_limit=plugin.get_setting('history_limit', int),
+        source=library,
+    )
+elif os.path.isfile(library_db):
+    # switched back from the SQLite backend, the database is moved away so
+    # switching again copies the storages into a new one
+    sqlite_library = SqliteLibrary(library_db)
+    library.import_library(sqlite_library)
+    sqlite_library.close()
+    if os.name == 'nt' and os.path.exists(library_db + '.bak'):
+        os.remove(library_db + '.bak')
+    os.rename(library_db, library_db + '.bak')
+pending_plays = PendingPlays(
+    os.path.join(plugin.storage_path, 'history.pending')
+)
+revalidations = OrderedDict()  # key -> the call refreshing the entry
+templates = {}
+cache = ResponseCache(
+    db_path=os.path.join(plugin.storage_path, 'cache.db'),
+    max_bytes=plugin.get_setting('cache_size', int) * 1024 * 1024,
+    max_stale=plugin.get_setting('cache_max_stale', int) * 60 * 60,
 )
 
 
@@ -179,6 +285,9 @@ def show_root_menu():
         {'label': _('show_downloaded_albums'),
          'path': plugin.url_for(endpoint='show_downloaded_albums'),
          'thumbnail': 'DefaultMusicPlaylists.png'},
+        {'label': _('show_download_queue'),
+         'path': plugin.url_for(endpoint='show_download_queue'),
+         'thumbnail': 'DefaultMusicPlaylists.png'},
         {'label': _('show_mixtapes'),
          'path': plugin.url_for(endpoint='show_mixtapes'),
          'thumbnail': 'DefaultMusicSongs.png'},
@@ -262,7 +371,11 @@ def show_albums():
     items = format_albums(albums)
     items.append(get_sort_method_switcher_item('albums', sort_method))
     items.extend(get_page_switcher_items(len(items)))
-    return add_items(items)
+    result = add_items(items)
+    prefetch_next_page(
+        albums, api.get_albums, page=page, sort_method=sort_method
+    )
+    return result
 
 
 @plugin.route('/albums/<artist_id>/')
@@ -282,7 +395,11 @@ def show_artists():
     items = format_artists(artists)
     items.append(get_sort_method_switcher_item('artists', sort_method))
     items.extend(get_page_switcher_items(len(items)))
-    return add_items(items)
+    result = add_items(items)
+    prefetch_next_page(
+        artists, api.get_artists, page=page, sort_method=sort_method
+    )
+    return result
 
 
 @plugin.route('/artists/near/')
@@ -315,7 +432,9 @@ def show_playlists():
     playlists = get_cached(api.get_playlists, page=page)
     items = format_playlists(playlists)
     items.extend(get_page_switcher_items(len(items)))
-    return add_items(items, same_cover=True)
+    result = add_items(items, same_cover=True)
+    prefetch_next_page(playlists, api.get_playlists, page=page)
+    return result
 
 
 @plugin.route('/radios/')
@@ -342,7 +461,15 @@ def show_tracks():
     items.append(get_sort_method_switcher_item('tracks', sort_method))
     items.append(get_tag_filter_item())
     items.extend(get_page_switcher_items(len(items)))
-    return add_items(items)
+    result = add_items(items)
+    prefetch_next_page(
+        tracks,
+        api.get_tracks,
+        page=page,
+        sort_method=sort_method,
+        tags=tags
+    )
+    return result
 
 
 @plugin.route('/tracks/album/<album_id>/')
@@ -365,7 +492,15 @@ def show_featured_tracks():
     )
     items = format_tracks(tracks)
     items.extend(get_page_switcher_items(len(items)))
-    return add_items(items)
+    result = add_items(items)
+    prefetch_next_page(
+        tracks,
+        api.get_tracks,
+        page=page,
+        sort_method=sort_method,
+        featured=True
+    )
+    return result
 
 
 @plugin.route('/tracks/playlist/<playlist_id>/')
@@ -500,41 +635,90 @@ def show_user_tracks():
 
 @plugin.route('/downloads/albums/')
 def show_downloaded_albums():
-    downloads = plugin.get_storage('downloaded_albums')
-    if downloads.items():
-        albums = [t['data'] for t in downloads.itervalues()]
+    collect_queued_downloads()
+    album_ids, has_next_page = get_library_page(
+        library.get_downloaded_album_ids
+    )
+    if album_ids:
+        albums = get_entities('albums', album_ids)
         items = format_downloaded_albums(albums)
+        items.extend(get_page_switcher_items(len(items), has_next_page))
         return add_items(items)
     plugin.notify(_('downloads_empty'))
 
 
 @plugin.route('/downloads/albums/<album_id>/')
 def show_downloaded_album_tracks(album_id):
-    downloads = plugin.get_storage('downloaded_albums')
-    album = downloads[album_id]
-    tracks = [t['data'] for t in album['tracks'].itervalues()]
+    track_ids = library.get_downloaded_album_track_ids(album_id)
+    tracks = get_entities('tracks', track_ids)
     items = format_tracks(tracks)
     return add_items(items, same_cover=True)
 
 
 @plugin.route('/downloads/tracks/')
 def show_downloaded_tracks():
-    downloads = plugin.get_storage('downloaded_tracks')
-    if downloads.items():
-        tracks = [t['data'] for t in downloads.itervalues()]
+    collect_queued_downloads()
+    track_ids, has_next_page = get_library_page(
+        library.get_downloaded_track_ids
+    )
+    if track_ids:
+        tracks = get_entities('tracks', track_ids)
         items = format_tracks(tracks)
+        items.extend(get_page_switcher_items(len(items), has_next_page))
         return add_items(items)
     plugin.notify(_('downloads_empty'))
 
 
+@plugin.route('/downloads/queue/')
+def show_download_queue():
+    collect_queued_downloads()
+    jobs = download_queue.get_jobs()
+    if jobs:
+        items = format_download_jobs(jobs)
+        return add_static_items(items)
+    plugin.notify(_('download_queue_empty'))
+
+
+@plugin.route('/downloads/queue/add/track/<track_id>')
+def queue_download_track(track_id):
+    if download_queue.enqueue('track', track_id):
+        plugin.notify(msg=_('download_queued'))
+    else:
+        plugin.notify(msg=_('already_queued'))
+
+
+@plugin.route('/downloads/queue/add/album/<album_id>')
+def queue_download_album(album_id):
+    if download_queue.enqueue('album', album_id):
+        plugin.notify(msg=_('download_queued'))
+    else:
+        plugin.notify(msg=_('already_queued'))
+
+
+@plugin.route('/downloads/queue/retry/<job_id>')
+def retry_download_job(job_id):
+    download_queue.retry(int(job_id))
+    _refresh_view()
+
+
+@plugin.route('/downloads/queue/remove/<job_id>')
+def remove_download_job(job_id):
+    download_queue.remove(int(job_id))
+    _refresh_view()
+
+
 ############################### History #######################################
 
 @plugin.route('/history/')
 def show_history():
-    history = plugin.get_storage('history')
-    tracks = history.get('items', [])
-    if tracks:
-        items = format_tracks(reversed(tracks))
+    flush_history()
+    track_ids, has_next_page = get_library_page(
+        library.get_played_track_ids
+    )
+    if track_ids:
+        tracks = get_entities('tracks', track_ids)
+        items = format_tracks(tracks)
+        items.extend(get_page_switcher_items(len(items), has_next_page))
         return add_items(items)
     plugin.notify(_('history_empty'))
 
@@ -543,8 +727,8 @@ def show_history():
 
 @plugin.route('/mixtapes/')
 def show_mixtapes():
-    mixtapes = plugin.get_storage('mixtapes')
-    items = format_mixtapes(mixtapes)
+    mixtape_ids = library.get_mixtape_ids()
+    items = format_mixtapes(mixtape_ids)
     items.append(get_add_mixtape_item())
     return add_static_items(items)
 
@@ -555,49 +739,43 @@ def add_mixtape(return_name=False):
         heading=_('mixtape_name')
     )
     if name:
-        mixtapes = plugin.get_storage('mixtapes')
-        if not name in mixtapes:
-            mixtapes[name] = []
-            mixtapes.sync()
+        library.add_mixtape(name)
         if return_name:
             return name
 
 
 @plugin.route('/mixtapes/del/<mixtape_id>')
 def del_mixtape(mixtape_id):
-    mixtapes = plugin.get_storage('mixtapes')
     confirmed = xbmcgui.Dialog().yesno(
         _('delete_mixtape_head'),
         _('are_you_sure')
     )
-    if confirmed and mixtape_id in mixtapes:
-        del mixtapes[mixtape_id]
-        mixtapes.sync()
+    if confirmed:
+        library.del_mixtape(mixtape_id)
         _refresh_view()
 
 
 @plugin.route('/mixtapes/rename/<mixtape_id>')
 def rename_mixtape(mixtape_id):
-    mixtapes = plugin.get_storage('mixtapes')
-    mixtape = mixtapes.pop(mixtape_id)
     new_mixtape_id = plugin.keyboard(
         heading=_('mixtape_name'),
         default=mixtape_id
     )
-    mixtapes[new_mixtape_id] = mixtape
-    mixtapes.sync()
-    _refresh_view()
+    if new_mixtape_id and new_mixtape_id != mixtape_id:
+        if not library.rename_mixtape(mixtape_id, new_mixtape_id):
+            plugin.notify(msg=_('mixtape_exists'))
+            return
+        _refresh_view()
 
 
 @plugin.route('/mixtapes/add/<track_id>')
 def add_del_track_to_mixtape(track_id):
-    mixtapes = plugin.get_storage('mixtapes')
+    track_mixtape_ids = library.get_track_mixtape_ids(track_id)
     items = [{
         'label':_('add_to_new_mixtape'),
     }]
-    for (mixtape_id, mixtape) in mixtapes.iteritems():
-        track_ids = [t['id'] for t in mixtape]
-        if track_id in track_ids:
+    for mixtape_id in library.get_mixtape_ids():
+        if mixtape_id in track_mixtape_ids:
             items.append({
                 'label': _('del_from_mixtape_s') % mixtape_id.decode('utf-8'),
                 'action': 'del',
@@ -627,28 +805,24 @@ def add_del_track_to_mixtape(track_id):
 
 @plugin.route('/mixtapes/<mixtape_id>/')
 def show_mixtape(mixtape_id):
-    mixtapes = plugin.get_storage('mixtapes')
-    tracks = mixtapes[mixtape_id]
+    track_ids, has_next_page = get_library_page(
+        library.get_mixtape_track_ids, mixtape_id
+    )
+    tracks = get_entities('tracks', track_ids)
     items = format_tracks(tracks)
+    items.extend(get_page_switcher_items(len(items), has_next_page))
     return add_items(items)
 
 
 @plugin.route('/mixtapes/<mixtape_id>/add/<track_id>')
 def add_track_to_mixtape(mixtape_id, track_id):
-    mixtapes = plugin.get_storage('mixtapes')
-    track = get_cached(api.get_track, track_id)
-    mixtapes[mixtape_id].append(track)
-    mixtapes.sync()
+    # Only the id is stored, the track is looked up when showing the mixtape
+    library.add_mixtape_track(mixtape_id, track_id)
 
 
 @plugin.route('/mixtapes/<mixtape_id>/del/<track_id>')
 def del_track_from_mixtape(mixtape_id, track_id):
-    mixtapes = plugin.get_storage('mixtapes')
-    mixtapes[mixtape_id] = [
-        t for t in mixtapes[mixtape_id]
-        if not t['id'] == track_id
-    ]
-    mixtapes.sync()
+    library.del_mixtape_track(mixtape_id, track_id)
 
 
 ########################### Callback Views ####################################
@@ -675,15 +849,13 @@ def download_track(track_id):
     if not download_path:
         return
     show_progress = plugin.get_setting('show_track_download_progress', bool)
-    downloader = JamendoDownloader(api, download_path, show_progress)
+    downloader = get_downloader(download_path, show_progress)
     formats = ('mp3', 'ogg', 'flac')
     audioformat = plugin.get_setting('download_format', choices=formats)
     include_cover = plugin.get_setting('download_track_cover', bool)
     tracks = downloader.download_tracks([track_id], audioformat, include_cover)
     if tracks:
-        downloaded_tracks = plugin.get_storage('downloaded_tracks')
-        downloaded_tracks.update(tracks)
-        downloaded_tracks.sync()
+        add_downloads('track', tracks)
         plugin.notify(msg=_('download_suceeded'))
 
 
@@ -693,15 +865,13 @@ def download_album(album_id):
     if not download_path:
         return
     show_progress = plugin.get_setting('show_album_download_progress', bool)
-    downloader = JamendoDownloader(api, download_path, show_progress)
+    downloader = get_downloader(download_path, show_progress)
     formats = ('mp3', 'ogg', 'flac')
     audioformat = plugin.get_setting('download_format', choices=formats)
     include_cover = plugin.get_setting('download_album_cover', bool)
     album = downloader.download_album(album_id, audioformat, include_cover)
     if album:
-        downloaded_albums = plugin.get_storage('downloaded_albums')
-        downloaded_albums.update(album)
-        downloaded_albums.sync()
+        add_downloads('album', album)
         plugin.notify(msg=_('download_suceeded'))
 
 
@@ -713,13 +883,29 @@ def play_radio(radio_id):
 
 @plugin.route('/play/track/<track_id>')
 def play_track(track_id):
-    add_track_to_history(track_id)
+    add_track_to_history(track_id)  # only queued, see flush_history
     track_url = get_downloaded_track(track_id)
     if not track_url:
+        window = xbmcgui.Window(10000)
+        if window.getProperty('JamBMC.playing_track') == track_id:
+            # the last try to play this track never started (the service
+            # clears the property once playback started), so its stream
+            # url may be dead
+            log('Track %s did not start last time, dropping its stream url'
+                % track_id)
+            stream_url_cache.invalidate(track_id)
         formats = ('mp3', 'ogg')
         audioformat = plugin.get_setting('playback_format', choices=formats)
         track_url = api.get_track_url(track_id, audioformat)
-    return plugin.set_resolved_url(track_url)
+        window.setProperty('JamBMC.playing_track', track_id)
+    resolve_ahead(plugin.get_setting('play_ahead_tracks', int))
+    resolved = plugin.set_resolved_url(track_url)
+    # the history is written once kodi got the url, or by the next call
+    def flush():
+        with api.background():
+            flush_history()
+    threading.Thread(target=flush, name='history').start()
+    return resolved
 
 
 @plugin.route('/settings')
@@ -727,6 +913,38 @@ def open_settings():
     plugin.open_settings()
 
 
+@plugin.route('/cache/stats/')
+def show_cache_stats():
+    stats = cache.get_stats()
+    entity_stats = entity_store.get_stats()
+    xbmcgui.Dialog().ok(
+        _('cache_stats_head'),
+        _('cache_entries_s_size_s') % (
+            stats['entries'],
+            '%0.1f' % (
+                (stats['size'] + entity_stats['size']) / 1024.0 / 1024
+            ),
+            '%0.1f' % (stats['max_size'] / 1024.0 / 1024),
+        ),
+        '%s, %s' % (
+            _('cache_hits_s_misses_s') % (stats['hits'], stats['misses']),
+            _('cache_entities_s') % entity_stats['entities'],
+        ),
+        '%s, %s, %s' % (
+            _('cache_stale_hits_s') % stats['stale_hits'],
+            _('cache_revalidations_s') % stats['revalidations'],
+            _('cache_evictions_s') % stats['evictions'],
+        )
+    )
+
+
+@plugin.route('/cache/clear/')
+def clear_cache():
+    cache.clear()
+    entity_store.clear(library.get_referenced_ids())
+    plugin.notify(msg=_('cache_cleared'))
+
+
 ############################# Formaters #######################################
 
 def format_albums(albums):
@@ -745,7 +963,7 @@ def format_albums(albums):
         ),
         'replace_context_menu': True,
         'thumbnail': album['image'],
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='show_tracks_in_album',
             album_id=album['id']
         )
@@ -761,10 +979,10 @@ def format_artists(artists):
             'count': i + 2,
             'artist': artist['name'],
         },
-        'context_menu': context_menu_artist(artist['id']),
+        'context_menu': context_menu_artist(artist_id=artist['id']),
         'replace_context_menu': True,
         'thumbnail': get_artist_image(artist['image']),
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='show_albums_by_artist',
             artist_id=artist['id'],
         )
@@ -784,10 +1002,10 @@ def format_artists_location(artists):
             'count': i + 2,
             'artist': artist['name'],
         },
-        'context_menu': context_menu_artist(artist['id']),
+        'context_menu': context_menu_artist(artist_id=artist['id']),
         'replace_context_menu': True,
         'thumbnail': get_artist_image(artist['image']),
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='show_albums_by_artist',
             artist_id=artist['id'],
         )
@@ -828,7 +1046,7 @@ def format_downloaded_albums(albums):
         ),
         'replace_context_menu': True,
         'thumbnail': album['image'],
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='show_downloaded_album_tracks',
             album_id=album['id']
         )
@@ -836,7 +1054,41 @@ def format_downloaded_albums(albums):
     return items
 
 
-def format_mixtapes(mixtapes):
+def format_download_jobs(jobs):
+    track_ids = [j['entity_id'] for j in jobs if j['kind'] == 'track']
+    album_ids = [j['entity_id'] for j in jobs if j['kind'] == 'album']
+    entities = dict(
+        (('track', t['id']), u'%s - %s' % (t['artist_name'], t['name']))
+        for t in get_entities('tracks', track_ids)
+    )
+    entities.update(
+        (('album', a['id']), u'%s - %s' % (a['artist_name'], a['name']))
+        for a in get_entities('albums', album_ids)
+    )
+    items = [{
+        'label': u'[%s] %s' % (
+            _('job_state_%s' % job['state']),
+            entities.get((job['kind'], job['entity_id']), job['entity_id'])
+        ),
+        'info': {
+            'count': i + 1,
+            'comment': job['error'] or '',
+        },
+        'context_menu': (
+            context_menu_failed_download_job(job_id=job['id'])
+            if job['state'] == FAILED
+            else context_menu_download_job(job_id=job['id'])
+        ),
+        'replace_context_menu': True,
+        'path': plugin.url_for(
+            endpoint='show_download_queue',
+            is_update='true',
+        )
+    } for i, job in enumerate(jobs)]
+    return items
+
+
+def format_mixtapes(mixtape_ids):
     items = [{
         'label': mixtape_id,
         'info': {
@@ -850,7 +1102,7 @@ def format_mixtapes(mixtapes):
             endpoint='show_mixtape',
             mixtape_id=mixtape_id
         )
-    } for i, (mixtape_id, mixtape) in enumerate(mixtapes.iteritems())]
+    } for i, mixtape_id in enumerate(mixtape_ids)]
     return items
 
 
@@ -866,7 +1118,7 @@ def format_playlists(playlists):
         },
         'context_menu': context_menu_empty(),
         'replace_context_menu': True,
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='show_tracks_in_playlist',
             playlist_id=playlist['id']
         )
@@ -891,7 +1143,7 @@ def format_playlist_tracks(playlist, tracks):
         ),
         'replace_context_menu': True,
         'is_playable': True,
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='play_track',
             track_id=track['id']
         )
@@ -910,7 +1162,7 @@ def format_radios(radios):
         'replace_context_menu': True,
         'thumbnail': radio['image'],
         'is_playable': True,
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='play_radio',
             radio_id=radio['id'],
         )
@@ -942,7 +1194,7 @@ def format_similar_tracks(tracks):
         'replace_context_menu': True,
         'is_playable': True,
         'thumbnail': track['album_image'],
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='play_track',
             track_id=track['id']
         )
@@ -1039,7 +1291,7 @@ def format_tracks(tracks):
         'replace_context_menu': True,
         'is_playable': True,
         'thumbnail': track['album_image'],
-        'path': plugin.url_for(
+        'path': _url(
             endpoint='play_track',
             track_id=track['id']
         )
@@ -1063,9 +1315,10 @@ def get_add_mixtape_item():
     }
 
 
-def get_page_switcher_items(items_len):
+def get_page_switcher_items(items_len, has_next_page=None):
     current_page = int(get_args('page', 1))
-    has_next_page = items_len >= api.current_limit
+    if has_next_page is None:
+        has_next_page = items_len >= api.current_limit
     has_previous_page = current_page > 1
     original_params = plugin.request.view_params
     extra_params = {}
@@ -1160,6 +1413,7 @@ def get_tag_filter_item():
 ############################ Item-Adders ######################################
 
 def add_items(items, same_cover=False):
+    set_current_listing()
     is_update = 'is_update' in plugin.request.args
     finish_kwargs = {
         'update_listing': is_update,
@@ -1173,6 +1427,7 @@ def add_items(items, same_cover=False):
 
 
 def add_static_items(items):
+    set_current_listing()
     for item in items:
         if not 'context_menu' in item:
             item['context_menu'] = context_menu_empty()
@@ -1183,8 +1438,67 @@ def add_static_items(items):
         return plugin.finish(items)
 
 
+############################# Templates #######################################
+
+def menu_template(func):
+    # The context menu is built (and its strings resolved) only once per
+    # invocation with placeholders, later calls only substitute the ids
+    @wraps(func)
+    def wrapper(**ids):
+        if not _numeric_ids(ids):
+            return func(**ids)
+        key = (func.__name__, tuple(sorted(ids)))
+        if key not in templates:
+            placeholders = _get_placeholders(ids)
+            templates[key] = [
+                (label, _make_template(command, placeholders))
+                for label, command in func(**placeholders)
+            ]
+        return [
+            (label, command % ids) for label, command in templates[key]
+        ]
+    return wrapper
+
+
+def _url(endpoint, **ids):
+    # plugin.url_for for urls which only differ in their numeric ids
+    if not _numeric_ids(ids):
+        return plugin.url_for(endpoint, **ids)
+    key = (endpoint, tuple(sorted(ids)))
+    if key not in templates:
+        placeholders = _get_placeholders(ids)
+        templates[key] = _make_template(
+            plugin.url_for(endpoint, **placeholders), placeholders
+        )
+    return templates[key] % ids
+
+
+def _numeric_ids(ids):
+    # numeric ids are the same before and after url quoting, so they can be
+    # substituted into an already quoted url. Converts the ids to str.
+    for key, value in ids.iteritems():
+        if not NUMERIC_ID_RE.match(unicode(value)):
+            return False
+        ids[key] = str(value)
+    return True
+
+
+def _get_placeholders(ids):
+    return dict(
+        (key, 'JAMBMCPLACEHOLDER%dX' % i) for i, key in enumerate(sorted(ids))
+    )
+
+
+def _make_template(text, placeholders):
+    template = text.replace('%', '%%')
+    for key, placeholder in placeholders.iteritems():
+        template = template.replace(placeholder, '%%(%s)s' % key)
+    return template
+
+
 ############################ Context-Menu #####################################
 
+@menu_template
 def context_menu_album(artist_id, album_id):
     return [
         (_('album_info'),
@@ -1192,6 +1506,9 @@ def context_menu_album(artist_id, album_id):
         (_('download_album'),
          _run(endpoint='download_album',
               album_id=album_id)),
+        (_('queue_download_album'),
+         _run(endpoint='queue_download_album',
+              album_id=album_id)),
         (_('show_tracks_in_this_album'),
          _view(endpoint='show_tracks_in_album',
                album_id=album_id)),
@@ -1203,6 +1520,7 @@ def context_menu_album(artist_id, album_id):
     ]
 
 
+@menu_template
 def context_menu_artist(artist_id):
     return [
         (_('show_albums_by_this_artist'),
@@ -1213,6 +1531,32 @@ def context_menu_artist(artist_id):
     ]
 
 
+@menu_template
+def context_menu_download_job(job_id):
+    return [
+        (_('remove_download'),
+         _run(endpoint='remove_download_job',
+              job_id=job_id)),
+        (_('addon_settings'),
+         _run(endpoint='open_settings')),
+    ]
+
+
+@menu_template
+def context_menu_failed_download_job(job_id):
+    return [
+        (_('retry_download'),
+         _run(endpoint='retry_download_job',
+              job_id=job_id)),
+        (_('remove_download'),
+         _run(endpoint='remove_download_job',
+              job_id=job_id)),
+        (_('addon_settings'),
+         _run(endpoint='open_settings')),
+    ]
+
+
+@menu_template
 def context_menu_empty():
     return [
         (_('addon_settings'),
@@ -1220,6 +1564,7 @@ def context_menu_empty():
     ]
 
 
+@menu_template
 def context_menu_mixtape(mixtape_id):
     return [
         (_('rename_mixtape'),
@@ -1233,6 +1578,7 @@ def context_menu_mixtape(mixtape_id):
     ]
 
 
+@menu_template
 def context_menu_track(artist_id, track_id, album_id):
     return [
         (_('song_info'),
@@ -1240,6 +1586,9 @@ def context_menu_track(artist_id, track_id, album_id):
         (_('download_track'),
          _run(endpoint='download_track',
               track_id=track_id)),
+        (_('queue_download_track'),
+         _run(endpoint='queue_download_track',
+              track_id=track_id)),
         (_('add_del_track_to_mixtape'),
          _run(endpoint='add_del_track_to_mixtape',
               track_id=track_id)),
@@ -1282,10 +1631,205 @@ def get_args(arg_name, default=None):
 
 
 def get_cached(func, *args, **kwargs):
-    @plugin.cached(kwargs.pop('TTL', 1440))
-    def wrap(func_name, *args, **kwargs):
-        return func(*args, **kwargs)
-    return wrap(func.__name__, *args, **kwargs)
+    ttl = kwargs.pop('TTL', None)
+    ttl = ttl * 60 if ttl else cache.get_ttl(func.__name__, kwargs)
+    key = cache.make_key(func.__name__, args, kwargs)
+    allow_stale = plugin.get_setting('stale_while_revalidate', bool)
+    found, value, stale = cache.get(key, allow_stale=allow_stale)
+    if found:
+        value = entity_store.resolve(value)
+        found = value is not None
+    if not found:
+        try:
+            value = fetch_cached(key, ttl, func, *args, **kwargs)
+        except ConnectionError:
+            # while the API is failing, any cached page is better than none
+            found, value, stale = cache.get(
+                key, allow_stale=True, max_stale=float('inf')
+            )
+            value = entity_store.resolve(value) if found else None
+            if value is None:
+                raise
+            log('API unreachable, using expired cache entry: %s' % key)
+    elif stale:
+        revalidate_cached(key, ttl, func, *args, **kwargs)
+    return value
+
+
+def revalidate_cached(key, ttl, func, *args, **kwargs):
+    # Queues the refresh of a stale cache entry, it is started by
+    # start_revalidations() once the view has been rendered
+    revalidations.setdefault(key, (ttl, func, args, kwargs))
+
+
+def start_revalidations():
+    # Refreshes the queued stale cache entries one after another, so they
+    # don't compete with the view's requests. The (non daemon) thread keeps
+    # the plugin process alive until it is done.
+    def refresh():
+        for key, (ttl, func, args, kwargs) in revalidations.items():
+            try:
+                with api.background():
+                    fetch_cached(key, ttl, func, *args, **kwargs)
+                log('Revalidated cache entry: %s' % key)
+            except Exception, e:
+                log('Revalidation of "%s" failed: %s' % (key, e))
+    if revalidations:
+        threading.Thread(target=refresh, name='revalidate').start()
+
+
+def prefetch_next_page(results, func, **kwargs):
+    # Loads the next page of a full listing into the cache, called after
+    # the view has been rendered. It is skipped if the user opened another
+    # listing meanwhile, the (non daemon) thread keeps the plugin process
+    # alive.
+    if not plugin.get_setting('prefetch_next_page', bool):
+        return
+    if len(results) < api.current_limit:
+        return
+    kwargs['page'] = kwargs['page'] + 1
+    listing = plugin.request.url
+    ttl = cache.get_ttl(func.__name__, kwargs)
+    key = cache.make_key(func.__name__, (), kwargs)
+
+    def canceled():
+        if get_current_listing() != listing:
+            log('Prefetch of page %d canceled' % kwargs['page'])
+            return True
+
+    def prefetch():
+        time.sleep(PREFETCH_DELAY)  # the user may still be paging
+        if canceled() or cache.get(key)[0]:
+            return
+        slot = take_prefetch_slot()
+        if slot is None:
+            log('Prefetch of page %d skipped, no free slot' % kwargs['page'])
+            return
+        try:
+            if canceled():
+                return
+            # conditional like any other request, with validators stored
+            with api.background():
+                fetch_cached(key, ttl, func, **kwargs)
+            log('Prefetched page %d' % kwargs['page'])
+        except Exception, e:
+            log('Prefetch of page %d failed: %s' % (kwargs['page'], e))
+        finally:
+            release_prefetch_slot(slot)
+    threading.Thread(target=prefetch, name='prefetch').start()
+
+
+def take_prefetch_slot():
+    # The PREFETCH_WORKERS slots are window properties, so they are shared
+    # by all plugin invocations. Returns the taken slot or None.
+    window = xbmcgui.Window(10000)
+    token = '%s %d %f' % (
+        os.getpid(), threading.current_thread().ident, time.time()
+    )
+    for i in xrange(PREFETCH_WORKERS):
+        name = 'JamBMC.prefetch.%d' % i
+        taken = window.getProperty(name)
+        if taken and float(taken.split()[-1]) + PREFETCH_TIMEOUT > time.time():
+            continue
+        window.setProperty(name, token)
+        if window.getProperty(name) == token:
+            return name, token
+
+
+def release_prefetch_slot(slot):
+    name, token = slot
+    window = xbmcgui.Window(10000)
+    if window.getProperty(name) == token:
+        window.clearProperty(name)
+
+
+def resolve_ahead(count):
+    # Resolves the stream urls of the next tracks in the music playlist
+    # while the current one starts. This also stores their metadata, so
+    # adding them to the history needs no request either.
+    playlist = xbmc.PlayList(xbmc.PLAYLIST_MUSIC)
+    position = playlist.getposition()
+    if not count or position < 0:
+        return
+    track_ids = []
+    for i in xrange(position + 1, min(position + 1 + count, playlist.size())):
+        match = PLAY_TRACK_RE.search(playlist[i].getfilename())
+        if match and not library.get_downloaded_file(match.group(1)):
+            track_ids.append(match.group(1))
+    if not track_ids:
+        return
+    formats = ('mp3', 'ogg')
+    audioformat = plugin.get_setting('playback_format', choices=formats)
+
+    def resolve():
+        try:
+            with api.background():
+                fetched = api.prefetch_track_urls(track_ids, audioformat)
+            log('Resolved %d of the next %d tracks' % (
+                fetched, len(track_ids)
+            ))
+        except Exception, e:
+            log('Resolving the next tracks failed: %s' % e)
+    threading.Thread(target=resolve, name='resolve_ahead').start()
+
+
+def set_current_listing():
+    # The current listing is shared between the plugin invocations
+    listing = plugin.request.url
+    xbmcgui.Window(10000).setProperty('JamBMC.listing', listing)
+    return listing
+
+
+def get_current_listing():
+    return xbmcgui.Window(10000).getProperty('JamBMC.listing')
+
+
+def fetch_cached(key, ttl, func, *args, **kwargs):
+    # Calls func and caches its result. If there is an expired entry, the
+    # request is made conditional: if Jamendo answers with 304 or returns
+    # the same content again only the TTL of the entry is extended.
+    value = validators = None
+    expired = cache.get_expired(key)
+    if expired and expired[1]:
+        value = entity_store.resolve(expired[0])
+        if value is not None:
+            validators = expired[1]
+    try:
+        result, new_validators = api.call_conditional(
+            validators, func, *args, **kwargs
+        )
+    except NotModified:
+        cache.refresh(key, ttl)
+        return value
+    if validators and new_validators and \
+            validators['hash'] == new_validators['hash']:
+        cache.refresh(key, ttl)
+        return value
+    set_cached(key, func.__name__, result, ttl, new_validators)
+    return result
+
+
+def set_cached(key, func_name, value, ttl, validators=None):
+    # Entities are cached once in the entity store, listings only keep ids
+    kind = ENDPOINT_KINDS.get(func_name)
+    cache.set(key, make_refs(kind, value) if kind else value, ttl, validators)
+
+
+def get_library_page(func, *args):
+    # Returns (ids, has_next_page), only the ids of the current page are read
+    page = int(get_args('page', 1))
+    limit = api.current_limit
+    ids = func(*args, offset=(page - 1) * limit, limit=limit + 1)
+    return ids[:limit], len(ids) > limit
+
+
+def get_entities(kind, entity_ids):
+    get_by_ids = {
+        'albums': api.get_albums_by_ids,
+        'artists': api.get_artists_by_ids,
+        'tracks': api.get_tracks_by_ids,
+    }[kind]
+    return get_by_ids(entity_ids)
 
 
 def get_download_path(setting_name):
@@ -1306,18 +1850,29 @@ def get_download_path(setting_name):
     return download_path
 
 
+def get_downloader(download_path, show_progress):
+    return JamendoDownloader(
+        api,
+        download_path,
+        show_progress,
+        workers=plugin.get_setting('download_workers', int),
+        host_connections=plugin.get_setting('download_host_connections', int),
+    )
+
+
 def get_downloaded_track(track_id):
-    tracks = plugin.get_storage('downloaded_tracks')
-    if track_id in tracks:
-        if xbmcvfs.exists(tracks[track_id]['file']):
+    # tracks downloaded by the service are in the library once a download
+    # view collected them, collecting here would slow down every play
+    entry = library.get_downloaded_file(track_id)
+    if entry:
+        if entry['verified'] + DOWNLOAD_VERIFY_INTERVAL > time.time():
+            log('Track is already downloaded, playing local')
+            return entry['file']
+        if xbmcvfs.exists(entry['file']):
             log('Track is already downloaded, playing local')
-            return tracks[track_id]['file']
-    albums = plugin.get_storage('downloaded_albums')
-    for album in albums.itervalues():
-        if track_id in album['tracks']:
-            if xbmcvfs.exists(album['tracks'][track_id]['file']):
-                log('Album is already downloaded, playing local')
-                return album['tracks'][track_id]['file']
+            library.set_download_verified(track_id, time.time())
+            return entry['file']
+        log('Downloaded track is missing: %s' % entry['file'])
 
 
 def get_artist_image(url):
@@ -1343,28 +1898,67 @@ def get_user_account():
 
 
 def add_track_to_history(track_id):
-    history = plugin.get_storage('history')
-    history_limit = plugin.get_setting('history_limit', int)
-    if not 'items' in history:
-        history['items'] = []
-    if not track_id in [t['id'] for t in history['items']]:
-        track = get_cached(api.get_track, track_id)
+    pending_plays.add(track_id)
+
+
+def flush_history():
+    # Writes the queued plays to the library
+    entries = pending_plays.take()
+    if not entries:
+        return
+    try:
+        # makes sure the tracks are stored, fetches the missing in one call
+        get_entities('tracks', [entry[0] for entry in entries])
+    except (ApiError, ConnectionError), e:
+        log('Could not store played tracks: %s' % e)
+    try:
+        library.add_played_many(entries)
+    except Exception:
+        pending_plays.add_many(entries)  # retried by the next flush
+        raise
+    log('Added %d plays to the history' % len(entries))
+
+
+def prune_entities():
+    # The entities share the cache size with the cached responses, the
+    # ones the library refers to are kept
+    if not entity_store.changed:
+        return
+    max_bytes = max(cache.max_bytes - cache.get_stats()['size'], 0)
+    if entity_store.needs_prune(max_bytes):
+        entity_store.prune(library.get_referenced_ids(), max_bytes)
+
+
+def collect_queued_downloads():
+    # Moves downloads finished by the background service (service.py) into
+    # the library
+    if not os.path.isfile(download_queue.db_path):
+        return
+    for kind, result in download_queue.collect_results():
+        add_downloads(kind, result)
+
+
+def add_downloads(kind, result):
+    if kind == 'track':
+        normalize_downloaded_tracks(result, entity_store)
+        library.add_downloaded_tracks(result)
     else:
-        track = [t for t in history['items'] if t['id'] == track_id][0]
-        history['items'] = [
-            t for t in history['items'] if not t['id'] == track_id
-        ]
-    history['items'].append(track)
-    if history_limit:
-        while len(history['items']) > history_limit:
-            history['items'].pop(0)
-    history.sync()
+        normalize_downloaded_albums(result, entity_store)
+        library.add_downloaded_albums(result)
 
 
 def log(text):
     plugin.log.info(text)
 
 
+def remove_legacy_cache():
+    # plugin.cached() kept every listing forever in this pickled storage
+    legacy_cache = os.path.join(plugin.storage_path, '.functions')
+    if os.path.isfile(legacy_cache):
+        log('Removing legacy function cache')
+        os.remove(legacy_cache)
+
+
 def fix_xbmc_music_library_view():
     # avoid context menu replacing bug by
     # switching window from musiclibrary to musicfiles
@@ -1382,7 +1976,9 @@ def _(string_id):
 
 if __name__ == '__main__':
     try:
+        remove_legacy_cache()
         plugin.run()
+        start_revalidations()
     except ApiError, message:
         xbmcgui.Dialog().ok(
             _('api_error'),
@@ -1397,3 +1993,7 @@ if __name__ == '__main__':
             _('check_network_or'),
             _('try_again_later')
         )
+    finally:
+        api.log_connection_stats()
+        cache.log_stats()
+        prune_entities()
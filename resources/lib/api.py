@@ -17,7 +17,17 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import hashlib
+import random
+import threading
+import time
+from contextlib import contextmanager
+from Queue import Queue, Empty
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from resources.lib.throttle import TokenBucket, SingleFlight
 
 
 API_URL = '%(scheme)s://api.jamendo.com/v3.0/'
@@ -46,6 +56,22 @@ AUDIO_FORMATS = {
 USER_TRACK_RELATIONS = (
     'like', 'favorite', 'review'
 )
+MAX_IDS_PER_CALL = 100
+RETRY_BACKOFF = 0.5  # seconds, doubled with every retry
+RATE_LIMIT = 5  # requests per second
+RATE_BURST = 10
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+if hasattr(requests.exceptions, 'ChunkedEncodingError'):  # requests >= 2.0
+    TRANSIENT_ERRORS += (requests.exceptions.ChunkedEncodingError, )
+# Fields only present in complete entities, e.g. similar tracks lack musicinfo
+COMPLETE_ENTITY_FIELDS = {
+    'albums': ('image', ),
+    'artists': ('image', ),
+    'tracks': ('musicinfo', ),
+}
 IMAGE_SIZES = {
     'big': '600',
     'medium': '400',
@@ -80,6 +106,16 @@ TAGS = (
 )
 
 
+# Shared by all JamendoApi instances of a process, so background threads
+# (prefetch, revalidation, downloads) count against the same budget. Pass a
+# SharedTokenBucket as background_rate_limiter to share the budget of the
+# background work between processes.
+rate_limiter = TokenBucket(RATE_LIMIT, RATE_BURST)
+single_flight = SingleFlight()
+# Set in threads doing background work, see JamendoApi.background()
+_context = threading.local()
+
+
 class AuthError(Exception):
     pass
 
@@ -92,23 +128,49 @@ class ConnectionError(Exception):
     pass
 
 
+class NotModified(Exception):
+    pass
+
+
 class JamendoApi():
 
     def __init__(self, client_id, use_https=True, limit=100,
-                 audioformat=None, image_size=None):
+                 audioformat=None, image_size=None, pool_size=4, timeout=10,
+                 entity_store=None, retries=2, circuit_breaker=None,
+                 stream_url_cache=None, rate_limiter=rate_limiter,
+                 background_rate_limiter=None):
         self._client_id = client_id
         self._use_https = bool(use_https)
         self._audioformat = AUDIO_FORMATS.get(audioformat, 'mp32')
         self._limit = min(int(limit), 100)
         self._image_size = IMAGE_SIZES.get(image_size, '400')
+        self._timeout = timeout
+        self._pool_size = max(int(pool_size), 1)
+        self._session = self._create_session(self._pool_size)
+        self._entity_store = entity_store
+        self._local = threading.local()
+        self._retries = max(int(retries), 0)
+        self._circuit_breaker = circuit_breaker
+        self._stream_url_cache = stream_url_cache
+        self._rate_limiter = rate_limiter
+        self._background_rate_limiter = background_rate_limiter or \
+            rate_limiter
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'retries': 0,
+            'failures': 0,
+            'throttled': 0,
+            'coalesced': 0,
+        }
 
     def get_albums(self, page=1, artist_id=None, sort_method=None,
-                   search_terms=None, ids=None):
+                   search_terms=None, ids=None, limit=None):
         path = 'albums'
+        limit = limit or self._limit
         params = {
             'imagesize': self._image_size,
-            'limit': self._limit,
-            'offset': self._limit * (int(page) - 1),
+            'limit': limit,
+            'offset': limit * (int(page) - 1),
         }
         if artist_id:
             params['artist_id'] = [artist_id]
@@ -119,13 +181,16 @@ class JamendoApi():
         if ids:
             params['id'] = '+'.join(ids)
         albums = self._api_call(path, params)
+        self._store_entities('albums', albums)
         return albums
 
-    def get_playlists(self, page=1, search_terms=None, user_id=None):
+    def get_playlists(self, page=1, search_terms=None, user_id=None,
+                      limit=None):
         path = 'playlists'
+        limit = limit or self._limit
         params = {
-            'limit': self._limit,
-            'offset': self._limit * (int(page) - 1)
+            'limit': limit,
+            'offset': limit * (int(page) - 1)
         }
         if search_terms:
             params['namesearch'] = search_terms
@@ -135,11 +200,12 @@ class JamendoApi():
         return playlists
 
     def get_artists(self, page=1, sort_method=None, search_terms=None,
-                    ids=None):
+                    ids=None, limit=None):
         path = 'artists'
+        limit = limit or self._limit
         params = {
-            'limit': self._limit,
-            'offset': self._limit * (int(page) - 1),
+            'limit': limit,
+            'offset': limit * (int(page) - 1),
         }
         if sort_method:
             params['order'] = sort_method
@@ -148,6 +214,7 @@ class JamendoApi():
         if ids:
             params['id'] = '+'.join(ids)
         artists = self._api_call(path, params)
+        self._store_entities('artists', artists)
         return artists
 
     def get_artists_by_location(self, coords, radius=100):
@@ -158,14 +225,17 @@ class JamendoApi():
             'haslocation': True,
         }
         artists = self._api_call(path, params)
+        self._store_entities('artists', artists)
         return artists
 
     def get_tracks(self, page=1, sort_method=None, filter_dict=None, tags=None,
-                   audioformat=None, album_id=None, ids=None, featured=False):
+                   audioformat=None, album_id=None, ids=None, featured=False,
+                   limit=None):
         path = 'tracks'
+        limit = limit or self._limit
         params = {
-            'limit': self._limit,
-            'offset': self._limit * (int(page) - 1),
+            'limit': limit,
+            'offset': limit * (int(page) - 1),
             'include': 'musicinfo',
             'audioformat': AUDIO_FORMATS.get(audioformat) or self._audioformat,
             'imagesize': self._image_size,
@@ -183,6 +253,8 @@ class JamendoApi():
         if tags:
             params['tags'] = tags
         tracks = self._api_call(path, params)
+        self._store_entities('tracks', tracks)
+        self._store_stream_urls(tracks, params['audioformat'])
         return tracks
 
     def get_radios(self, page=1):
@@ -213,6 +285,7 @@ class JamendoApi():
             'imagesize': self._image_size,
         }
         tracks = self._api_call(path, params)
+        self._store_entities('tracks', tracks)
         return tracks
 
     def search_tracks(self, search_terms, page=1):
@@ -233,16 +306,71 @@ class JamendoApi():
         )
         return albums[0]
 
+    def get_tracks_by_ids(self, track_ids, audioformat=None, use_cache=True):
+        return self._get_by_ids(
+            'tracks', self.get_tracks, track_ids, use_cache,
+            audioformat=audioformat
+        )
+
+    def get_albums_by_ids(self, album_ids, use_cache=True):
+        return self._get_by_ids(
+            'albums', self.get_albums, album_ids, use_cache
+        )
+
+    def get_artists_by_ids(self, artist_ids, use_cache=True):
+        return self._get_by_ids(
+            'artists', self.get_artists, artist_ids, use_cache
+        )
+
+    def iter_albums(self, page_size=None, look_ahead=False, **kwargs):
+        return self._iter_pages(self.get_albums, page_size, look_ahead, kwargs)
+
+    def iter_artists(self, page_size=None, look_ahead=False, **kwargs):
+        return self._iter_pages(
+            self.get_artists, page_size, look_ahead, kwargs
+        )
+
+    def iter_tracks(self, page_size=None, look_ahead=False, **kwargs):
+        return self._iter_pages(self.get_tracks, page_size, look_ahead, kwargs)
+
+    def iter_playlists(self, page_size=None, look_ahead=False, **kwargs):
+        return self._iter_pages(
+            self.get_playlists, page_size, look_ahead, kwargs
+        )
+
     def get_track_url(self, track_id, audioformat=None):
         path = 'tracks/file'
+        audioformat = AUDIO_FORMATS.get(audioformat) or self._audioformat
+        if self._stream_url_cache is not None:
+            track_url = self._stream_url_cache.get(track_id, audioformat)
+            if track_url:
+                self.log('get_track_url cached track_url: %s' % track_url)
+                return track_url
         params = {
-            'audioformat': AUDIO_FORMATS.get(audioformat) or self._audioformat,
+            'audioformat': audioformat,
             'id': track_id
         }
         track_url = self._get_redirect_location(path, params)
         self.log('get_track_url track_url: %s' % track_url)
+        if self._stream_url_cache is not None:
+            self._stream_url_cache.set(track_id, audioformat, track_url)
         return track_url
 
+    def prefetch_track_urls(self, track_ids, audioformat=None):
+        # Puts the stream urls of the tracks into the stream url cache with
+        # one batched call, returns the number of tracks fetched
+        if self._stream_url_cache is None:
+            return 0
+        code = AUDIO_FORMATS.get(audioformat) or self._audioformat
+        missing_ids = [
+            i for i in track_ids if not self._stream_url_cache.get(i, code)
+        ]
+        if missing_ids:
+            self.get_tracks_by_ids(
+                missing_ids, audioformat=audioformat, use_cache=False
+            )
+        return len(missing_ids)
+
     def get_radio_url(self, radio_id):
         path = 'radios/stream'
         params = {
@@ -272,8 +400,8 @@ class JamendoApi():
         }
         users = self._api_call(path, params)
         if users and users[0].get('artists'):
-            artist_ids = set((a['id'] for a in users[0]['artists']))
-            return self.get_artists(ids=artist_ids)
+            artist_ids = [a['id'] for a in users[0]['artists']]
+            return self.get_artists_by_ids(artist_ids)
         return []
 
     def get_user_albums(self, user_id, page=1):
@@ -286,8 +414,8 @@ class JamendoApi():
         }
         users = self._api_call(path, params)
         if users and users[0].get('albums'):
-            album_ids = set((a['id'] for a in users[0]['albums']))
-            return self.get_albums(ids=album_ids)
+            album_ids = [a['id'] for a in users[0]['albums']]
+            return self.get_albums_by_ids(album_ids)
         return []
 
     def get_user_tracks(self, user_id, relations=None, page=1):
@@ -300,10 +428,109 @@ class JamendoApi():
         }
         users = self._api_call(path, params)
         if users and users[0].get('tracks'):
-            track_ids = set((a['id'] for a in users[0]['tracks']))
-            return self.get_tracks(ids=track_ids)
+            track_ids = [a['id'] for a in users[0]['tracks']]
+            return self.get_tracks_by_ids(track_ids)
         return []
 
+    def call_conditional(self, validators, func, *args, **kwargs):
+        # Calls func, its API request is made conditional with the given
+        # validators (as returned before). Returns (result, validators),
+        # validators is None if func made more than one API request.
+        # Raises NotModified if Jamendo answered with 304.
+        self._local.request_validators = validators
+        self._local.response_validators = []
+        try:
+            result = func(*args, **kwargs)
+            response_validators = self._local.response_validators
+        finally:
+            self._local.request_validators = None
+            self._local.response_validators = None
+        if len(response_validators) == 1:
+            return result, response_validators[0]
+        return result, None
+
+    @contextmanager
+    def background(self):
+        # Requests of the current thread (and the threads it starts through
+        # this api) are background work, throttled by the
+        # background_rate_limiter. The foreground requests of a view stay
+        # off its (possibly shared and locking) bucket.
+        background = getattr(_context, 'background', False)
+        _context.background = True
+        try:
+            yield
+        finally:
+            _context.background = background
+
+    def gather(self, *calls):
+        # Runs independent (method, args, kwargs) calls concurrently over the
+        # shared connection pool and returns their results in order
+        return _run_concurrent(list(calls), self._pool_size)
+
+    def _get_by_ids(self, kind, fetch, entity_ids, use_cache, **kwargs):
+        # Returns the entities in the order of the (deduplicated) ids, ids
+        # unknown to Jamendo are left out
+        entity_ids = _unique([unicode(i) for i in entity_ids])
+        entities = {}
+        if use_cache and self._entity_store is not None:
+            fields = COMPLETE_ENTITY_FIELDS[kind]
+            stored = self._entity_store.get_many(kind, entity_ids)
+            entities.update(
+                (entity_id, entity) for entity_id, entity in stored.iteritems()
+                if all(field in entity for field in fields)
+            )
+        missing_ids = [i for i in entity_ids if not i in entities]
+        calls = [
+            (fetch, (), dict(kwargs, ids=chunk, limit=len(chunk)))
+            for chunk in _chunks(missing_ids, MAX_IDS_PER_CALL)
+        ]
+        self.log('_get_by_ids %s: %d cached, %d requests' % (
+            kind, len(entity_ids) - len(missing_ids), len(calls)
+        ))
+        for results in _run_concurrent(calls, self._pool_size):
+            entities.update((unicode(e['id']), e) for e in results)
+        return [entities[i] for i in entity_ids if i in entities]
+
+    def _iter_pages(self, fetch, page_size, look_ahead, kwargs):
+        # Yields the results of all pages, with look_ahead the next page is
+        # fetched in the background while the current one is consumed
+        page_size = min(int(page_size or self._limit), 100)
+
+        def fetch_page(page):
+            results = fetch(page=page, limit=page_size, **kwargs)
+            return results, getattr(self._local, 'headers', {})
+
+        page = 1
+        pending = _BackgroundCall(fetch_page, page) if look_ahead else None
+        while True:
+            if pending:
+                results, headers = pending.result()
+            else:
+                results, headers = fetch_page(page)
+            if 'next' in headers:
+                has_next_page = bool(headers['next'])
+            else:
+                count = headers.get('results_count', len(results))
+                has_next_page = count >= page_size
+            page += 1
+            if has_next_page and look_ahead:
+                pending = _BackgroundCall(fetch_page, page)
+            for result in results:
+                yield result
+            if not has_next_page:
+                return
+
+    def _store_entities(self, kind, entities):
+        if self._entity_store is not None:
+            self._entity_store.put_many(kind, entities)
+
+    def _store_stream_urls(self, tracks, audioformat):
+        if self._stream_url_cache is not None:
+            self._stream_url_cache.set_many(
+                (t['id'], audioformat, t['audio'])
+                for t in tracks if t.get('audio')
+            )
+
     def _get_redirect_location(self, path, params={}):
         headers = {
             'user-agent': USER_AGENT
@@ -311,31 +538,31 @@ class JamendoApi():
         params.update({
             'client_id': self._client_id,
         })
-        request = requests.get(
-            self._api_url + path,
-            headers=headers,
-            params=params,
-            verify=False,
-            allow_redirects=False
-        )
+        request = self._get(path, params, headers, allow_redirects=False)
         return request.headers['Location']
 
     def _api_call(self, path, params={}):
         headers = {
             'content-type': 'application/json',
-            'user-agent': USER_AGENT
+            'user-agent': USER_AGENT,
+            'accept-encoding': 'gzip',
         }
         params.update({
             'client_id': self._client_id,
             'format': 'json'
         })
-        request = requests.get(
-            self._api_url + path,
-            headers=headers,
-            params=params,
-            verify=False  # XBMCs requests' SSL certificates are too old
-        )
+        validators = getattr(self._local, 'request_validators', None)
+        if validators:
+            self._local.request_validators = None  # only the first request
+            if validators.get('etag'):
+                headers['if-none-match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['if-modified-since'] = validators['last_modified']
+        request = self._get(path, params, headers)
         self.log(u'_api_call using URL: %s' % request.url)
+        if request.status_code == 304:
+            self.log(u'_api_call got 304 Not Modified')
+            raise NotModified(path)
         json_data = request.json()
         return_code = json_data.get('headers', {}).get('code')
         if not return_code == 0:
@@ -345,9 +572,123 @@ class JamendoApi():
                 raise ApiError(json_data['headers']['error_message'])
         if json_data.get('headers', {}).get('warnings'):
             self.log('API-Warning: %s' % json_data['headers']['warnings'])
+        # per thread, read by _iter_pages after the call returned
+        self._local.headers = json_data.get('headers', {})
+        response_validators = getattr(self._local, 'response_validators', None)
+        if response_validators is not None:
+            response_validators.append({
+                'etag': request.headers.get('ETag'),
+                'last_modified': request.headers.get('Last-Modified'),
+                'hash': hashlib.sha1(request.content).hexdigest(),
+            })
         self.log(u'_api_call got %d bytes response' % len(request.text))
         return json_data.get('results', [])
 
+    def _get(self, path, params, headers, **kwargs):
+        # Identical requests running at the same time share one response
+        key = repr((
+            path,
+            sorted(params.items()),
+            sorted(headers.items()),
+            sorted(kwargs.items()),
+        ))
+        response, shared = single_flight.do(
+            key, self._request, path, params, headers, **kwargs
+        )
+        if shared:
+            self._count('coalesced')
+        return response
+
+    def _request(self, path, params, headers, **kwargs):
+        # Retries connection errors, timeouts and 5xx responses with a
+        # jittered exponential backoff, raises ConnectionError if all
+        # attempts failed or the circuit breaker is open
+        breaker = self._circuit_breaker
+        if breaker is not None and not breaker.allow():
+            raise ConnectionError('Circuit open, not requesting %s' % path)
+        for attempt in xrange(self._retries + 1):
+            if attempt:
+                self._count('retries')
+                time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+            if getattr(_context, 'background', False):
+                limiter = self._background_rate_limiter
+            else:
+                limiter = self._rate_limiter
+            if limiter.acquire():
+                self._count('throttled')
+            try:
+                response = self._session.get(
+                    self._api_url + path,
+                    headers=headers,
+                    params=params,
+                    timeout=self._timeout,
+                    verify=False,  # XBMCs requests' SSL certs are too old
+                    **kwargs
+                )
+            except TRANSIENT_ERRORS, e:
+                error = e
+                self.log('_get attempt %d of %s failed: %s' % (
+                    attempt + 1, path, e
+                ))
+                continue
+            if response.status_code >= 500:
+                error = 'HTTP %d' % response.status_code
+                self.log('_get attempt %d of %s failed: %s' % (
+                    attempt + 1, path, error
+                ))
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return response
+        self._count('failures')
+        if breaker is not None:
+            breaker.record_failure()
+        raise ConnectionError('Requesting %s failed: %s' % (path, error))
+
+    def _count(self, name):
+        # called from the worker threads too
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    @staticmethod
+    def _create_session(pool_size):
+        # One keep-alive pool for all endpoints, so only the first request of
+        # a plugin invocation pays for the TCP (and TLS) handshake
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_connection_stats(self):
+        stats = {'requests': 0, 'opened': 0, 'reused': 0}
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['opened'] += pool.num_connections
+        stats['reused'] = max(stats['requests'] - stats['opened'], 0)
+        stats.update(self._stats)
+        return stats
+
+    def log_connection_stats(self):
+        self.log(
+            'connections: %(requests)d requests, %(opened)d opened, '
+            '%(reused)d reused, %(retries)d retries, %(failures)d failures, '
+            '%(throttled)d throttled, %(coalesced)d coalesced'
+            % self.get_connection_stats()
+        )
+        if self._circuit_breaker is not None:
+            self.log(
+                'circuit: %(state)s, opened %(open_count)d times, '
+                '%(open_seconds)d seconds open'
+                % self._circuit_breaker.get_stats()
+            )
+
     @property
     def current_limit(self):
         return self._limit
@@ -367,3 +708,78 @@ class JamendoApi():
 
     def log(self, message):
         print u'[%s]: %s' % (self.__class__.__name__, repr(message))
+
+
+def _unique(items):
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+class _BackgroundCall(threading.Thread):
+    # Runs func(*args) in a thread, result() waits for it and re-raises
+    # its exception
+
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self, name='api-call')
+        self.daemon = True
+        self._func = func
+        self._args = args
+        self._result = None
+        self._error = None
+        self._background = getattr(_context, 'background', False)
+        self.start()
+
+    def run(self):
+        _context.background = self._background
+        try:
+            self._result = self._func(*self._args)
+        except Exception, e:
+            self._error = e
+
+    def result(self):
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def _run_concurrent(calls, max_workers):
+    # Runs (func, args, kwargs) calls in up to max_workers threads and
+    # returns their results in the order of the calls
+    results = [None] * len(calls)
+    errors = []
+    queue = Queue()
+    for i, call in enumerate(calls):
+        queue.put((i, call))
+    background = getattr(_context, 'background', False)
+
+    def worker():
+        _context.background = background
+        while not errors:
+            try:
+                i, (func, args, kwargs) = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(*args, **kwargs)
+            except Exception, e:
+                errors.append(e)
+
+    if len(calls) == 1:
+        worker()
+    else:
+        threads = [
+            threading.Thread(target=worker)
+            for _ in xrange(min(max_workers, len(calls)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return results
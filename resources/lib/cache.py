@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+import threading
+import time
+import cPickle as pickle
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+DEFAULT_TTL = DAY
+ENDPOINT_TTLS = {
+    'get_album': 7 * DAY,
+    'get_track': 7 * DAY,
+    'get_artists_by_location': 7 * DAY,
+    'get_playlist_tracks': 6 * HOUR,
+    'get_radios': 7 * DAY,
+}
+# Sort orders which change quickly on Jamendo's side, matched by suffix
+SORT_METHOD_TTLS = (
+    ('_week', 2 * HOUR),
+    ('buzzrate', 2 * HOUR),
+    ('_month', 12 * HOUR),
+)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS entries ('
+    '    key TEXT PRIMARY KEY,'
+    '    value BLOB NOT NULL,'
+    '    size INTEGER NOT NULL,'
+    '    expires REAL NOT NULL,'
+    '    accessed REAL NOT NULL,'
+    '    validators BLOB'
+    ')',
+    'CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)',
+    'CREATE TABLE IF NOT EXISTS stats ('
+    '    name TEXT PRIMARY KEY,'
+    '    value INTEGER NOT NULL'
+    ')',
+)
+STATS = ('hits', 'stale_hits', 'misses', 'evictions', 'revalidations')
+
+STREAM_URL_TTL = HOUR
+MAX_STREAM_URLS = 2000
+STREAM_URL_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS stream_urls ('
+    '    track_id TEXT NOT NULL,'
+    '    audioformat TEXT NOT NULL,'
+    '    url TEXT NOT NULL,'
+    '    expires REAL NOT NULL,'
+    '    PRIMARY KEY (track_id, audioformat)'
+    ')',
+    'CREATE INDEX IF NOT EXISTS stream_urls_expires ON stream_urls (expires)',
+)
+
+
+class ResponseCache(object):
+
+    def __init__(self, db_path, max_bytes, ttls=None, max_stale=0):
+        self.db_path = db_path
+        self.max_bytes = int(max_bytes)
+        self.max_stale = max_stale
+        self.ttls = dict(ENDPOINT_TTLS, **(ttls or {}))
+        self._lock = threading.RLock()
+        self._conn = None
+        # access times and stats counters, written once by flush()
+        self._accessed = {}
+        self._counts = {}
+
+    @staticmethod
+    def make_key(endpoint, args=(), kwargs=None):
+        return repr((endpoint, tuple(args), sorted((kwargs or {}).items())))
+
+    def get_ttl(self, endpoint, kwargs=None):
+        sort_method = (kwargs or {}).get('sort_method') or ''
+        for suffix, ttl in SORT_METHOD_TTLS:
+            if sort_method.endswith(suffix):
+                return ttl
+        return self.ttls.get(endpoint, DEFAULT_TTL)
+
+    def get(self, key, allow_stale=False, max_stale=None):
+        # Returns (found, value, stale), expired entries are only returned
+        # with allow_stale and if they are not older than max_stale
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value, expires FROM entries WHERE key = ?', (key, )
+            ).fetchone()
+            now = time.time()
+            if max_stale is None:
+                max_stale = self.max_stale
+            if not allow_stale:
+                max_stale = 0
+            if row is None or row[1] + max_stale < now:
+                self._count('misses')
+                return False, None, False
+            stale = row[1] < now
+            self._accessed[key] = now
+            self._count('stale_hits' if stale else 'hits')
+        return True, pickle.loads(str(row[0])), stale
+
+    def get_expired(self, key):
+        # Returns (value, validators) of an entry regardless of its age or
+        # None, used to revalidate expired entries
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value, validators FROM entries WHERE key = ?', (key, )
+            ).fetchone()
+        if row is None:
+            return None
+        validators = pickle.loads(str(row[1])) if row[1] else None
+        return pickle.loads(str(row[0])), validators
+
+    def set(self, key, value, ttl, validators=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            log('Not caching %d bytes for key: %s' % (len(data), key))
+            return
+        if validators:
+            validators = sqlite3.Binary(pickle.dumps(validators, 2))
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(key, value, size, expires, accessed, validators) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, sqlite3.Binary(data), len(data), now + ttl, now,
+                 validators or None)
+            )
+            self._accessed.pop(key, None)
+            self._write_pending()  # the eviction needs the access times
+            self._evict(now)
+            self._db.commit()
+
+    def refresh(self, key, ttl):
+        # The entry was revalidated, it stays valid for another ttl seconds
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'UPDATE entries SET expires = ?, accessed = ? WHERE key = ?',
+                (now + ttl, now, key)
+            )
+            self._count('revalidations')
+            self._db.commit()
+
+    def flush(self):
+        # Writes the access times and stats collected since the last write
+        with self._lock:
+            if self._accessed or self._counts:
+                self._write_pending()
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._accessed.clear()
+            self._counts.clear()
+            self._db.execute('DELETE FROM entries')
+            self._db.execute('DELETE FROM stats')
+            self._db.commit()
+            self._db.execute('VACUUM')
+
+    def get_stats(self):
+        with self._lock:
+            self.flush()
+            entries, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries'
+            ).fetchone()
+            stats = dict.fromkeys(STATS, 0)
+            stats.update(self._db.execute('SELECT name, value FROM stats'))
+        stats.update({
+            'entries': entries,
+            'size': size,
+            'max_size': self.max_bytes,
+        })
+        return stats
+
+    def log_stats(self):
+        if self._conn is not None:
+            log(
+                '%(entries)d entries, %(size)d/%(max_size)d bytes, '
+                '%(hits)d hits, %(stale_hits)d stale hits, %(misses)d misses, '
+                '%(evictions)d evictions, %(revalidations)d revalidations'
+                % self.get_stats()
+            )
+
+    def _evict(self, now):
+        # Expired entries are kept until the cache is full: they are served
+        # while the API is unreachable and their validators make refreshing
+        # them conditional. They are evicted first, then the least recently
+        # used ones.
+        evicted = 0
+        size = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries'
+        ).fetchone()[0]
+        if size > self.max_bytes:
+            rows = self._db.execute(
+                'SELECT key, size FROM entries '
+                'ORDER BY expires >= ?, accessed', (now, )
+            ).fetchall()
+            for key, entry_size in rows:
+                if size <= self.max_bytes:
+                    break
+                self._db.execute('DELETE FROM entries WHERE key = ?', (key, ))
+                size -= entry_size
+                evicted += 1
+        if evicted:
+            self._count('evictions', evicted)
+
+    def _count(self, name, value=1):
+        self._counts[name] = self._counts.get(name, 0) + value
+
+    def _write_pending(self):
+        self._db.executemany(
+            'UPDATE entries SET accessed = ? WHERE key = ? AND accessed < ?',
+            ((accessed, key, accessed)
+             for key, accessed in self._accessed.iteritems())
+        )
+        self._db.executemany(
+            'INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)',
+            ((name, ) for name in self._counts)
+        )
+        self._db.executemany(
+            'UPDATE stats SET value = value + ? WHERE name = ?',
+            ((value, name) for name, value in self._counts.iteritems())
+        )
+        self._accessed.clear()
+        self._counts.clear()
+
+    @property
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.db_path,
+                timeout=10,
+                check_same_thread=False
+            )
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+            columns = [
+                row[1] for row in self._conn.execute(
+                    'PRAGMA table_info(entries)'
+                )
+            ]
+            if not 'validators' in columns:  # caches created before
+                self._conn.execute(
+                    'ALTER TABLE entries ADD COLUMN validators BLOB'
+                )
+            self._conn.commit()
+        return self._conn
+
+
+class StreamUrlCache(object):
+    # (track_id, audioformat) -> stream url, filled from track listings and
+    # resolved redirects, so playing a track can skip the tracks/file call
+
+    def __init__(self, db_path, ttl=STREAM_URL_TTL,
+                 max_entries=MAX_STREAM_URLS):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def get(self, track_id, audioformat):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT url FROM stream_urls WHERE track_id = ? '
+                'AND audioformat = ? AND expires > ?',
+                (unicode(track_id), audioformat, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_many(self, entries):
+        # entries: (track_id, audioformat, url) tuples
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO stream_urls '
+                '(track_id, audioformat, url, expires) VALUES (?, ?, ?, ?)',
+                ((unicode(track_id), audioformat, url, expires)
+                 for track_id, audioformat, url in entries)
+            )
+            self._db.execute(
+                'DELETE FROM stream_urls WHERE expires <= ? OR rowid IN ('
+                '    SELECT rowid FROM stream_urls ORDER BY expires DESC '
+                '    LIMIT -1 OFFSET ?'
+                ')', (time.time(), self.max_entries)
+            )
+            self._db.commit()
+
+    def set(self, track_id, audioformat, url):
+        self.set_many([(track_id, audioformat, url)])
+
+    def invalidate(self, track_id):
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM stream_urls WHERE track_id = ?',
+                (unicode(track_id), )
+            )
+            self._db.commit()
+
+    @property
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.db_path,
+                timeout=10,
+                check_same_thread=False
+            )
+            for statement in STREAM_URL_SCHEMA:
+                self._conn.execute(statement)
+            self._conn.commit()
+        return self._conn
+
+
+def log(msg):
+    print u'[ResponseCache]: %s' % repr(msg)
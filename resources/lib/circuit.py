@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+FAILURE_THRESHOLD = 3
+RESET_TIMEOUT = 60  # seconds
+
+
+class CircuitBreaker(object):
+    # Stops calling the API after FAILURE_THRESHOLD calls in a row failed.
+    # Once the circuit is open for reset_timeout seconds one trial call is
+    # let through (half-open), its success closes the circuit again. The
+    # state is kept in a file as every plugin invocation starts from
+    # scratch.
+
+    def __init__(self, path, failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT):
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.RLock()
+        self._state = None
+
+    def allow(self):
+        now = time.time()
+        with self._lock:
+            state = self.state
+            if state['opened'] is None:
+                return True
+            if state['opened'] + self.reset_timeout > now:
+                return False
+            if state['probing'] and \
+                    state['probing'] + self.reset_timeout > now:
+                return False  # another call is the trial call
+            state['probing'] = now
+            self._save()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            state = self.state
+            if state['failures'] or state['opened'] is not None:
+                if state['opened'] is not None:
+                    state['open_seconds'] += time.time() - state['opened']
+                    log('Circuit closed')
+                state.update(failures=0, opened=None, probing=None)
+                self._save()
+
+    def record_failure(self):
+        now = time.time()
+        with self._lock:
+            state = self.state
+            state['failures'] += 1
+            if state['opened'] is not None:
+                # the trial call failed, stay open for another reset_timeout
+                state['open_seconds'] += now - state['opened']
+                state['opened'] = now
+                state['probing'] = None
+            elif state['failures'] >= self.failure_threshold:
+                log('Circuit opened after %d failures' % state['failures'])
+                state['opened'] = now
+                state['open_count'] += 1
+            self._save()
+
+    def get_stats(self):
+        with self._lock:
+            state = self.state
+            open_seconds = state['open_seconds']
+            if state['opened'] is not None:
+                open_seconds += time.time() - state['opened']
+            return {
+                'state': 'closed' if state['opened'] is None else 'open',
+                'failures': state['failures'],
+                'open_count': state['open_count'],
+                'open_seconds': int(open_seconds),
+            }
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = {
+                'failures': 0,
+                'opened': None,
+                'probing': None,
+                'open_count': 0,
+                'open_seconds': 0,
+            }
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path) as f:
+                        self._state.update(json.load(f))
+                except ValueError:
+                    log('Ignoring broken state file: %s' % self.path)
+        return self._state
+
+    def _save(self):
+        # a unique temp file, plugin invocations may run at the same time
+        # (in the same Kodi process)
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.path), suffix='.tmp'
+        )
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._state, f)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)  # rename doesn't replace on windows
+        os.rename(temp_path, self.path)
+
+
+def log(msg):
+    print u'[CircuitBreaker]: %s' % repr(msg)
@@ -17,13 +17,18 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import json
 import os
-from urllib import urlretrieve
+import threading
+from Queue import Queue, Empty
+from urlparse import urlparse
 
+import requests
 import xbmc
 import xbmcaddon
 import xbmcvfs
 import xbmcgui
+from resources.lib.strings import StringTable
 
 STRINGS = {
     'progress_head': 30080,
@@ -33,7 +38,10 @@ STRINGS = {
     'current_file_s': 30084,
 }
 
+CHUNK_SIZE = 64 * 1024
+
 addon = xbmcaddon.Addon()
+strings = StringTable(STRINGS, addon.getLocalizedString)
 
 
 class DownloadAborted(Exception):
@@ -42,23 +50,45 @@ class DownloadAborted(Exception):
 
 class JamendoDownloader(object):
 
-    def __init__(self, api, download_path, show_progress=True):
+    def __init__(self, api, download_path, show_progress=True, workers=1,
+                 host_connections=2, retries=2, timeout=30,
+                 abort_requested=None):
         log('__init__ with path="%s"' % download_path)
         self.api = api
         self.download_path = download_path
         self.show_progress = show_progress
+        self.workers = max(int(workers), 1)
+        self.host_connections = max(int(host_connections), 1)
+        self.retries = retries
+        self.timeout = timeout
+        self.abort_requested = abort_requested  # e.g. on Kodi shutdown
+        self._session = requests.Session()
         self.temp_path = xbmc.translatePath(addon.getAddonInfo('profile'))
         if not xbmcvfs.exists(self.temp_path):
             xbmcvfs.mkdirs(self.temp_path)
+        self._lock = threading.Lock()
+        self._canceled = threading.Event()
+        self._host_slots = {}
+        self.errors = []  # unexpected errors of failed items, e.g. OSError
         self._init_progress()
 
+    @property
+    def canceled(self):
+        return self._canceled.is_set()
+
     def download_tracks(self, track_ids, audioformat, include_cover=True):
         downloaded_tracks = {}
         self._update_progress(10)
         line3 = _('downloading_to_s') % self.download_path
         self._update_progress(line3=line3)
-        for i, track_id in enumerate(track_ids):
-            track = self.api.get_track(track_id, audioformat=audioformat)
+        tracks = self.api.get_tracks_by_ids(
+            track_ids,
+            audioformat=audioformat,
+            use_cache=False  # the audio url depends on the audioformat
+        )
+        items = []
+        track_filenames = []
+        for track in tracks:
             filename = '%(artist)s - %(title)s (%(album)s) [%(year)s]' % {
                 'artist': track['artist_name'].encode('ascii', 'ignore'),
                 'title': track['name'].encode('ascii', 'ignore'),
@@ -66,26 +96,15 @@ class JamendoDownloader(object):
                 'year': track.get('releasedate', '0-0-0').split('-')[0],
             }
             if include_cover:
-                cover_url = track['album_image']
-                cover_filename = '%s.tbn' % filename
-                line2 = _('current_file_s') % cover_filename
-                self._update_progress(line2=line2)
-                self._download_item(cover_url, cover_filename)
-            percent = 10 + 90 / len(track_ids) * i
-            self._update_progress(percent)
+                items.append((track['album_image'], '%s.tbn' % filename))
             track_filename = '%s.%s' % (filename, audioformat)
-            line2 = _('current_file_s') % track_filename
-            self._update_progress(line2=line2)
-            try:
-                track_file = self._download_item(
-                    track['audio'],
-                    track_filename
-                )
-            except DownloadAborted:
-                return downloaded_tracks
-            if track_file:
-                downloaded_tracks[track_id] = {
-                    'file': track_file,
+            items.append((track['audio'], track_filename))
+            track_filenames.append((track, track_filename))
+        files = self._download_items(items)
+        for track, track_filename in track_filenames:
+            if files.get(track_filename):
+                downloaded_tracks[track['id']] = {
+                    'file': files[track_filename],
                     'data': track
                 }
         self._update_progress(100)
@@ -95,10 +114,12 @@ class JamendoDownloader(object):
         downloaded_album = {}
         downloaded_tracks = {}
         self._update_progress(2)
-        album = self.api.get_album(album_id=album_id)
-        tracks = self.api.get_tracks(
-            filter_dict={'album_id': album_id},
-            audioformat=audioformat
+        album, tracks = self.api.gather(
+            (self.api.get_album, (), {'album_id': album_id}),
+            (self.api.get_tracks, (), {
+                'filter_dict': {'album_id': album_id},
+                'audioformat': audioformat,
+            }),
         )
         self._update_progress(10)
         any_track = tracks[0]
@@ -112,34 +133,25 @@ class JamendoDownloader(object):
             xbmcvfs.mkdirs(self.download_path)
         line3 = _('downloading_to_s') % self.download_path
         self._update_progress(line3=line3)
+        items = []
         if include_cover:
-            cover_url = any_track['album_image']
-            cover_filename = 'folder.jpg'
-            line2 = _('current_file_s') % cover_filename
-            self._update_progress(line2=line2)
-            self._download_item(cover_url, cover_filename)
-        for i, track in enumerate(tracks):
+            items.append((any_track['album_image'], 'folder.jpg'))
+        track_filenames = []
+        for track in tracks:
             filename = '%(artist)s - %(title)s' % {
                 'artist': track['artist_name'].encode('ascii', 'ignore'),
                 'title': track['name'].encode('ascii', 'ignore'),
             }
             track_filename = '%s.%s' % (filename, audioformat)
-            line2 = _('current_file_s') % track_filename
-            self._update_progress(line2=line2)
-            try:
-                track_file = self._download_item(
-                    track['audio'],
-                    track_filename
-                )
-            except DownloadAborted:
-                break
-            if track_file:
+            items.append((track['audio'], track_filename))
+            track_filenames.append((track, track_filename))
+        files = self._download_items(items)
+        for track, track_filename in track_filenames:
+            if files.get(track_filename):
                 downloaded_tracks[track['id']] = {
-                    'file': track_file,
+                    'file': files[track_filename],
                     'data': track
                 }
-            percent = 10 + 90 / len(tracks) * (i + 1)
-            self._update_progress(percent)
         self._update_progress(100)
         downloaded_album[album['id']] = {
             'data': album,
@@ -147,23 +159,166 @@ class JamendoDownloader(object):
         }
         return downloaded_album
 
+    def _download_items(self, items):
+        # Downloads the (url, filename) items in up to self.workers threads
+        # while the progress dialog is updated here, in the calling thread.
+        # Returns a dict filename -> file of all finished items.
+        files = {}
+        queue = Queue()
+        for item in items:
+            queue.put(item)
+        self._progress = {
+            'done': 0,
+            'total': len(items),
+            'bytes': {},
+            'active': [],
+        }
+
+        def worker():
+            while not self._canceled.is_set():
+                try:
+                    url, filename = queue.get_nowait()
+                except Empty:
+                    return
+                with self._host_slot(url):
+                    with self._lock:
+                        self._progress['active'].append(filename)
+                    try:
+                        item_file = self._download_item(url, filename)
+                    except DownloadAborted:
+                        self._canceled.set()
+                        return
+                    except Exception, e:
+                        # e.g. a full disk, the other items are still tried
+                        log('Download of "%s" failed: %r' % (filename, e))
+                        with self._lock:
+                            self.errors.append(u'%r' % e)
+                        item_file = False
+                    finally:
+                        with self._lock:
+                            self._progress['active'].remove(filename)
+                with self._lock:
+                    files[filename] = item_file
+                    self._progress['done'] += 1
+
+        threads = [
+            threading.Thread(target=worker, name='download')
+            for _ in xrange(min(self.workers, len(items)))
+        ]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            self._refresh_progress()
+            xbmc.sleep(200)
+        for thread in threads:
+            thread.join()
+        self._refresh_progress()
+        return files
+
     def _download_item(self, url, filename):
         log('Downloading "%s" to "%s"' % (url, filename))
-        temp_file = os.path.join(self.temp_path, filename)
         final_file = os.path.join(self.download_path, filename)
-        try:
-            urlretrieve(url, temp_file, self.__progress_hook)
-        except IOError, e:
-            log('IOError: "%s"' % str(e))
+        local_path = _get_local_path(self.download_path)
+        if local_path:
+            # written in place and renamed, no second copy of the file
+            temp_file = os.path.join(local_path, '%s.part' % filename)
+        else:
+            temp_file = os.path.join(self.temp_path, filename)
+
+        for attempt in xrange(self.retries + 1):
+            try:
+                self._fetch(url, temp_file, filename)
+                break
+            except (IOError, requests.RequestException), e:
+                # the partial file is kept and resumed by the next attempt
+                log('IOError: "%s" (attempt %d)' % (str(e), attempt + 1))
+            except KeyboardInterrupt:
+                raise DownloadAborted
+        else:
             return False
-        except KeyboardInterrupt:
-            raise DownloadAborted
-        log('Moving "%s" to "%s"' % (temp_file, final_file))
-        xbmcvfs.copy(temp_file, final_file)
-        xbmcvfs.delete(temp_file)
+        if local_path:
+            local_file = os.path.join(local_path, filename)
+            log('Renaming "%s" to "%s"' % (temp_file, local_file))
+            if os.name == 'nt' and os.path.exists(local_file):
+                os.remove(local_file)  # rename doesn't replace on windows
+            os.rename(temp_file, local_file)
+        else:
+            log('Moving "%s" to "%s"' % (temp_file, final_file))
+            xbmcvfs.copy(temp_file, final_file)
+            xbmcvfs.delete(temp_file)
         log('Item Done')
         return final_file
 
+    def _fetch(self, url, path, filename):
+        # Downloads url to path, resuming a partial file with a Range request
+        # if the sidecar file says it belongs to the same url and version
+        state_file = '%s.json' % path
+        state = _load_state(state_file)
+        offset = 0
+        headers = {}
+        if state.get('url') == url and os.path.isfile(path):
+            offset = os.path.getsize(path)
+            if offset and offset == state.get('size'):
+                log('Partial file is already complete')
+                os.remove(state_file)
+                return
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+                if state.get('validator'):
+                    headers['If-Range'] = state['validator']
+        response = self._session.get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+            verify=False,  # XBMCs requests' SSL certs are too old
+        )
+        if response.status_code == 416 and offset:
+            # nothing left after offset, e.g. the sidecar file didn't know
+            # the size, or the partial file belongs to an older version
+            response.close()
+            os.remove(state_file)
+            if _get_total_size(response.headers) == offset:
+                log('Partial file is already complete')
+                return
+            log('Restarting download of "%s"' % filename)
+            os.remove(path)
+            return self._fetch(url, path, filename)
+        response.raise_for_status()
+        if response.status_code == 206:
+            log('Resuming "%s" at %d bytes' % (filename, offset))
+        else:
+            # the server ignored the range or the file has changed
+            offset = 0
+        size = int(response.headers.get('content-length') or 0)
+        expected_size = offset + size if size else None
+        _save_state(state_file, {
+            'url': url,
+            'size': expected_size,
+            'validator': _get_validator(response.headers),
+        })
+        with open(path, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if self._canceled.is_set():
+                    raise KeyboardInterrupt
+                f.write(chunk)
+                offset += len(chunk)
+                with self._lock:
+                    self._progress['bytes'][filename] = offset
+        if expected_size and offset < expected_size:
+            raise IOError('Connection closed at %d bytes' % offset)
+        os.remove(state_file)
+
+    def _host_slot(self, url):
+        # Limits the parallel connections per host
+        host = urlparse(url).netloc
+        with self._lock:
+            if not host in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(
+                    self.host_connections
+                )
+            return self._host_slots[host]
+
     def _init_progress(self):
         if self.show_progress:
             self.current_percent = 1
@@ -180,30 +335,80 @@ class JamendoDownloader(object):
                 self.current_percent, **kwargs
             )
 
+    def _refresh_progress(self):
+        if self.abort_requested is not None and self.abort_requested():
+            self._canceled.set()
+        if self.show_progress:
+            if self.progress_dialog.iscanceled():
+                self._canceled.set()
+            with self._lock:
+                done = self._progress['done']
+                total = self._progress['total']
+                current_bytes = sum(self._progress['bytes'].itervalues())
+                current_files = ', '.join(self._progress['active'])
+            current_mb = current_bytes / 1024.0 / 1024.0
+            self._update_progress(
+                10 + 90 * done / max(total, 1),
+                line1=_('current_progress_s_mb') % '%0.2f' % current_mb,
+                line2=_('current_file_s') % current_files,
+            )
+
     def _del_progress(self):
         if self.show_progress:
             self.progress_dialog.close()
             self.progress_dialog = None
 
-    def __progress_hook(self, block_count, block_size, item_size):
-        if self.show_progress:
-            if self.progress_dialog.iscanceled():
-                raise KeyboardInterrupt
-            current_mb = (block_count * block_size / 1024.0 / 1024.0)
-            line1 = _('current_progress_s_mb') % '%0.2f' % current_mb
-            self._update_progress(line1=line1)
-
     def __del__(self):
         self._del_progress()
 
 
+def _get_local_path(path):
+    # Returns the file system path for local and special:// paths and None
+    # for network paths like smb:// which are only accessible with xbmcvfs
+    path = xbmc.translatePath(path)
+    if '://' in path:
+        return None
+    return path
+
+
+def _get_validator(headers):
+    # If-Range requires a strong validator
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified')
+
+
+def _get_total_size(headers):
+    # from "Content-Range: bytes */<size>" of a 416 response
+    try:
+        return int(headers.get('content-range', '').rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _load_state(state_file):
+    if os.path.isfile(state_file):
+        try:
+            with open(state_file) as f:
+                return json.load(f)
+        except ValueError:
+            log('Ignoring broken state file: %s' % state_file)
+    return {}
+
+
+def _save_state(state_file, state):
+    with open(state_file, 'w') as f:
+        json.dump(state, f)
+
+
 def log(msg):
     xbmc.log(u'[JemandoDownloader]: %s' % msg.encode('utf8', 'ignore'))
 
 
 def _(string_id):
-    if string_id in STRINGS:
-        return addon.getLocalizedString(STRINGS[string_id])
-    else:
+    string = strings.get(string_id)
+    if string is None:
         log('String is missing: %s' % string_id)
         return string_id
+    return string
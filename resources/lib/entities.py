@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+import threading
+import time
+import cPickle as pickle
+
+# Kind of the entities returned by the JamendoApi methods
+ENDPOINT_KINDS = {
+    'get_albums': 'albums',
+    'get_album': 'albums',
+    'get_artists': 'artists',
+    'get_artists_by_location': 'artists',
+    'get_similar_tracks': 'tracks',
+    'get_tracks': 'tracks',
+    'get_track': 'tracks',
+}
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS entities ('
+    '    kind TEXT NOT NULL,'
+    '    id TEXT NOT NULL,'
+    '    data BLOB NOT NULL,'
+    '    updated REAL NOT NULL,'
+    '    PRIMARY KEY (kind, id)'
+    ')',
+    'CREATE INDEX IF NOT EXISTS entities_updated ON entities (updated)',
+    'CREATE TABLE IF NOT EXISTS meta ('
+    '    name TEXT PRIMARY KEY,'
+    '    value REAL NOT NULL'
+    ')',
+)
+MAX_AGE = 30 * 24 * 60 * 60  # seconds
+PRUNE_INTERVAL = 24 * 60 * 60  # seconds
+
+
+class EntityRefs(object):
+    # Cached instead of the entities itself, resolved by EntityStore.resolve
+
+    def __init__(self, kind, ids, single=False):
+        self.kind = kind
+        self.ids = ids
+        self.single = single
+
+
+class EntityStore(object):
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = None
+        self.changed = False
+
+    def put_many(self, kind, entities):
+        entities = dict((unicode(e['id']), e) for e in entities)
+        if not entities:
+            return
+        now = time.time()
+        with self._lock:
+            # Entities are merged, so partial results (e.g. similar tracks
+            # without musicinfo) don't drop fields from a complete entity
+            stored = self.get_many(kind, entities.keys())
+            for entity_id, entity in entities.iteritems():
+                if entity_id in stored:
+                    stored[entity_id].update(entity)
+                    entities[entity_id] = stored[entity_id]
+            self._db.executemany(
+                'INSERT OR REPLACE INTO entities (kind, id, data, updated) '
+                'VALUES (?, ?, ?, ?)',
+                ((kind, entity_id, sqlite3.Binary(_dumps(entity)), now)
+                 for entity_id, entity in entities.iteritems())
+            )
+            self._db.commit()
+            self.changed = True
+
+    def put(self, kind, entity):
+        self.put_many(kind, [entity])
+
+    def get_many(self, kind, entity_ids):
+        # Returns a dict id -> entity, missing entities are left out
+        entity_ids = [unicode(i) for i in entity_ids]
+        entities = {}
+        with self._lock:
+            # stay below SQLITE_MAX_VARIABLE_NUMBER
+            for i in xrange(0, len(entity_ids), 500):
+                chunk = entity_ids[i:i + 500]
+                rows = self._db.execute(
+                    'SELECT id, data FROM entities WHERE kind = ? '
+                    'AND id IN (%s)' % ', '.join('?' * len(chunk)),
+                    [kind] + chunk
+                )
+                for entity_id, data in rows:
+                    entities[entity_id] = pickle.loads(str(data))
+        return entities
+
+    def get(self, kind, entity_id):
+        return self.get_many(kind, [entity_id]).get(unicode(entity_id))
+
+    def get_ordered(self, kind, entity_ids):
+        # Returns (entities, missing_ids), entities in the given order
+        stored = self.get_many(kind, entity_ids)
+        entities = [
+            stored[unicode(i)] for i in entity_ids if unicode(i) in stored
+        ]
+        missing_ids = [i for i in entity_ids if not unicode(i) in stored]
+        return entities, missing_ids
+
+    def resolve(self, value):
+        # Returns None if any of the referenced entities is missing
+        if not isinstance(value, EntityRefs):
+            return value
+        entities, missing_ids = self.get_ordered(value.kind, value.ids)
+        if missing_ids:
+            return None
+        return entities[0] if value.single else entities
+
+    def get_stats(self):
+        with self._lock:
+            entities, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) '
+                'FROM entities'
+            ).fetchone()
+        return {'entities': entities, 'size': size}
+
+    def needs_prune(self, max_bytes):
+        # True if the store wasn't pruned for a while or grew over max_bytes
+        # plus the size of the entities which were kept by the last prune
+        with self._lock:
+            meta = dict(self._db.execute('SELECT name, value FROM meta'))
+        if meta.get('pruned', 0) + PRUNE_INTERVAL < time.time():
+            return True
+        return self.get_stats()['size'] > max_bytes + meta.get('kept', 0)
+
+    def prune(self, keep_ids, max_bytes, max_age=MAX_AGE):
+        # Deletes entities which are not in keep_ids (kind -> ids of e.g.
+        # the library) and were not updated for max_age seconds, then the
+        # least recently updated ones until they fit into max_bytes
+        now = time.time()
+        keep_ids = dict(
+            (kind, set(unicode(i) for i in ids))
+            for kind, ids in keep_ids.iteritems()
+        )
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT kind, id, LENGTH(data), updated FROM entities '
+                'ORDER BY updated'
+            ).fetchall()
+            kept = sum(
+                row[2] for row in rows if row[1] in keep_ids.get(row[0], ())
+            )
+            rows = [
+                row for row in rows
+                if not row[1] in keep_ids.get(row[0], ())
+            ]
+            size = sum(row[2] for row in rows)
+            deleted = []
+            for kind, entity_id, entity_size, updated in rows:
+                if updated + max_age >= now and size <= max_bytes:
+                    break
+                deleted.append((kind, entity_id))
+                size -= entity_size
+            self._db.executemany(
+                'DELETE FROM entities WHERE kind = ? AND id = ?', deleted
+            )
+            self._db.executemany(
+                'INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+                (('pruned', now), ('kept', kept))
+            )
+            self._db.commit()
+        if deleted:
+            log('Pruned %d entities' % len(deleted))
+        return len(deleted)
+
+    def clear(self, keep_ids):
+        # Deletes all entities which are not in keep_ids
+        self.prune(keep_ids, max_bytes=0)
+        with self._lock:
+            self._db.execute('VACUUM')
+
+    @property
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.db_path,
+                timeout=10,
+                check_same_thread=False
+            )
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+            self._conn.commit()
+        return self._conn
+
+
+def make_refs(kind, value):
+    if isinstance(value, dict):
+        return EntityRefs(kind, [value['id']], single=True)
+    return EntityRefs(kind, [e['id'] for e in value])
+
+
+def _dumps(entity):
+    return pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+
+
+def log(msg):
+    print u'[EntityStore]: %s' % repr(msg)
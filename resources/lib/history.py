@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+COMPACT_MIN_BYTES = 16 * 1024
+LINE_BYTES = 24  # rough size of one "<track_id>\t<timestamp>" line
+LOCK_TIMEOUT = 5  # seconds after which a lock is taken as left by a crash
+
+
+class PlayHistory(object):
+    # Append-only journal of played track ids. A play only appends one
+    # line, replays and the history limit are applied while reading and
+    # the journal is rewritten (compacted) after a play once it grew too
+    # much. Appends and rewrites are serialized with a lock directory as
+    # plugin invocations may write at the same time (in one Kodi process).
+
+    def __init__(self, path, limit=0):
+        self.path = path
+        self.limit = int(limit or 0)
+
+    def add(self, track_id, timestamp=None):
+        self.add_many([(track_id, timestamp or time.time())])
+
+    def add_many(self, entries):
+        with self._locked():
+            with open(self.path, 'a') as f:
+                f.writelines('%s\t%d\n' % entry for entry in entries)
+            if os.path.getsize(self.path) > self._compact_bytes:
+                entries, line_count = self._load()
+                if self.limit or line_count > 2 * len(entries):
+                    self._write(entries)
+
+    def get_track_ids(self):
+        # Returns the played track ids, the last played first
+        entries, line_count = self._load()
+        return list(reversed(entries.keys()))
+
+    def compact(self):
+        with self._locked():
+            entries, line_count = self._load()
+            self._write(entries)
+
+    def _write(self, entries):
+        # a unique temp file, like the circuit breaker state
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.path), suffix='.tmp'
+        )
+        with os.fdopen(fd, 'w') as f:
+            f.writelines('%s\t%d\n' % entry for entry in entries.iteritems())
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)  # rename doesn't replace on windows
+        os.rename(temp_path, self.path)
+
+    def replace(self, entries):
+        # entries: (track_id, timestamp) tuples, the last played last
+        with self._locked():
+            self._write(OrderedDict(entries))
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    @contextmanager
+    def _locked(self):
+        # mkdir is atomic, also between the interpreters of one process
+        lock_path = '%s.lock' % self.path
+        timeout = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                os.mkdir(lock_path)
+                break
+            except OSError:
+                if time.time() > timeout:
+                    break  # left by a crashed invocation, taken over
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            try:
+                os.rmdir(lock_path)
+            except OSError:
+                pass
+
+    def _load(self):
+        entries = OrderedDict()
+        line_count = 0
+        if not self.exists():
+            return entries, line_count
+        with open(self.path) as f:
+            for line in f:
+                line_count += 1
+                try:
+                    track_id, timestamp = line.rstrip('\n').split('\t')
+                    timestamp = int(timestamp)
+                except ValueError:
+                    continue  # e.g. a line cut off by a crash
+                entries.pop(track_id, None)  # a replay moves to the end
+                entries[track_id] = timestamp
+                if self.limit and len(entries) > self.limit:
+                    entries.popitem(last=False)
+        return entries, line_count
+
+    @property
+    def _compact_bytes(self):
+        return max(COMPACT_MIN_BYTES, 2 * self.limit * LINE_BYTES)
+
+
+class PendingPlays(object):
+    # Plays which are not yet written to the history. Queueing a play only
+    # appends a line, take() hands the queued plays to one caller.
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, track_id, timestamp=None):
+        self.add_many([(track_id, timestamp or time.time())])
+
+    def add_many(self, entries):
+        with open(self.path, 'a') as f:
+            f.writelines('%s\t%d\n' % entry for entry in entries)
+
+    def take(self):
+        # Returns and removes the queued (track_id, timestamp) plays
+        if not os.path.isfile(self.path):
+            return []
+        # unique per call, all plugin invocations share Kodi's pid
+        taken_path = '%s.%s' % (self.path, uuid.uuid4().hex)
+        try:
+            os.rename(self.path, taken_path)
+        except OSError:
+            return []  # taken by another invocation
+        entries = []
+        with open(taken_path) as f:
+            for line in f:
+                try:
+                    track_id, timestamp = line.rstrip('\n').split('\t')
+                    entries.append((track_id, int(timestamp)))
+                except ValueError:
+                    continue
+        os.remove(taken_path)
+        return entries
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+import threading
+import time
+import cPickle as pickle
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60  # doubled with every failed attempt
+KEEP_DONE = 24 * 60 * 60  # seconds a collected job stays in the queue
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS jobs ('
+    '    id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    '    kind TEXT NOT NULL,'
+    '    entity_id TEXT NOT NULL,'
+    '    state TEXT NOT NULL,'
+    '    attempts INTEGER NOT NULL DEFAULT 0,'
+    '    next_try REAL NOT NULL,'
+    '    error TEXT,'
+    '    result BLOB,'
+    '    collected INTEGER NOT NULL DEFAULT 0,'
+    '    created REAL NOT NULL,'
+    '    updated REAL NOT NULL'
+    ')',
+    'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, next_try)',
+)
+COLUMNS = (
+    'id', 'kind', 'entity_id', 'state', 'attempts', 'next_try', 'error',
+    'created', 'updated'
+)
+
+
+class DownloadQueue(object):
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def enqueue(self, kind, entity_id):
+        # Returns False if the entity is already waiting in the queue
+        now = time.time()
+        with self._lock:
+            pending = self._db.execute(
+                'SELECT id FROM jobs WHERE kind = ? AND entity_id = ? '
+                'AND state IN (?, ?)',
+                (kind, entity_id, QUEUED, RUNNING)
+            ).fetchone()
+            if pending:
+                return False
+            self._db.execute(
+                'INSERT INTO jobs '
+                '(kind, entity_id, state, next_try, created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, entity_id, QUEUED, now, now, now)
+            )
+            self._db.commit()
+        return True
+
+    def claim_next(self):
+        # Marks the next due job as running and returns it (or None)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT %s FROM jobs WHERE state = ? AND next_try <= ? '
+                'ORDER BY next_try, id LIMIT 1' % ', '.join(COLUMNS),
+                (QUEUED, now)
+            ).fetchone()
+            if row is None:
+                return None
+            job = dict(zip(COLUMNS, row))
+            self._set(job['id'], state=RUNNING, attempts=job['attempts'] + 1)
+            self._db.commit()
+        job.update(state=RUNNING, attempts=job['attempts'] + 1)
+        return job
+
+    def finish(self, job_id, result):
+        with self._lock:
+            self._set(
+                job_id,
+                state=DONE,
+                error=None,
+                result=sqlite3.Binary(pickle.dumps(result, 2))
+            )
+            self._db.commit()
+
+    def fail(self, job_id, error):
+        with self._lock:
+            attempts = self._db.execute(
+                'SELECT attempts FROM jobs WHERE id = ?', (job_id, )
+            ).fetchone()[0]
+            if attempts < MAX_ATTEMPTS:
+                self._set(
+                    job_id,
+                    state=QUEUED,
+                    error=error,
+                    next_try=time.time() + RETRY_DELAY * 2 ** (attempts - 1)
+                )
+            else:
+                self._set(job_id, state=FAILED, error=error)
+            self._db.commit()
+
+    def retry(self, job_id):
+        # Requeues a failed job, returns False for jobs in other states
+        with self._lock:
+            retried = self._db.execute(
+                'UPDATE jobs SET state = ?, attempts = 0, next_try = ?, '
+                'result = NULL, collected = 0, updated = ? '
+                'WHERE id = ? AND state = ?',
+                (QUEUED, time.time(), time.time(), job_id, FAILED)
+            ).rowcount
+            self._db.commit()
+        return bool(retried)
+
+    def remove(self, job_id):
+        with self._lock:
+            self._db.execute('DELETE FROM jobs WHERE id = ?', (job_id, ))
+            self._db.commit()
+
+    def recover(self):
+        # Jobs still running were interrupted by a crash or Kodi shutdown
+        with self._lock:
+            count = self._db.execute(
+                'UPDATE jobs SET state = ? WHERE state = ?', (QUEUED, RUNNING)
+            ).rowcount
+            self._db.commit()
+        return count
+
+    def collect_results(self):
+        # Returns the results of all finished but not yet collected jobs,
+        # jobs collected more than KEEP_DONE seconds ago are removed
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM jobs WHERE state = ? AND collected = 1 '
+                'AND updated < ?', (DONE, time.time() - KEEP_DONE)
+            )
+            rows = self._db.execute(
+                'SELECT id, kind, result FROM jobs '
+                'WHERE state = ? AND collected = 0',
+                (DONE, )
+            ).fetchall()
+            self._db.executemany(
+                'UPDATE jobs SET collected = 1, updated = ? WHERE id = ?',
+                ((time.time(), job_id) for job_id, kind, result in rows)
+            )
+            self._db.commit()
+        return [
+            (kind, pickle.loads(str(result))) for job_id, kind, result in rows
+        ]
+
+    def get_jobs(self):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT %s FROM jobs ORDER BY id' % ', '.join(COLUMNS)
+            ).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def _set(self, job_id, **values):
+        values['updated'] = time.time()
+        self._db.execute(
+            'UPDATE jobs SET %s WHERE id = ?' % ', '.join(
+                '%s = ?' % column for column in values
+            ),
+            values.values() + [job_id]
+        )
+
+    @property
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.db_path,
+                timeout=10,
+                check_same_thread=False
+            )
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+            self._conn.commit()
+        return self._conn
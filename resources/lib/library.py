@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+import threading
+import time
+
+DOWNLOAD_INDEX_VERSION = 1
+MIXTAPE_INDEX_VERSION = 1
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS meta ('
+    '    name TEXT PRIMARY KEY,'
+    '    value TEXT NOT NULL'
+    ')',
+    # a replay re-inserts the row, so the rowid is the play order
+    'CREATE TABLE IF NOT EXISTS history ('
+    '    track_id TEXT PRIMARY KEY,'
+    '    played REAL NOT NULL'
+    ')',
+    'CREATE TABLE IF NOT EXISTS mixtapes ('
+    '    id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    '    name TEXT NOT NULL UNIQUE'
+    ')',
+    'CREATE TABLE IF NOT EXISTS mixtape_tracks ('
+    '    mixtape_id INTEGER NOT NULL,'
+    '    position INTEGER NOT NULL,'
+    '    track_id TEXT NOT NULL,'
+    '    PRIMARY KEY (mixtape_id, position)'
+    ')',
+    'CREATE INDEX IF NOT EXISTS mixtape_tracks_track '
+    'ON mixtape_tracks (track_id)',
+    'CREATE TABLE IF NOT EXISTS downloaded_tracks ('
+    '    track_id TEXT PRIMARY KEY,'
+    '    file TEXT NOT NULL,'
+    '    verified REAL NOT NULL DEFAULT 0'
+    ')',
+    'CREATE TABLE IF NOT EXISTS downloaded_albums ('
+    '    album_id TEXT PRIMARY KEY'
+    ')',
+    'CREATE TABLE IF NOT EXISTS downloaded_album_tracks ('
+    '    album_id TEXT NOT NULL,'
+    '    track_id TEXT NOT NULL,'
+    '    file TEXT NOT NULL,'
+    '    verified REAL NOT NULL DEFAULT 0,'
+    '    PRIMARY KEY (album_id, track_id)'
+    ')',
+    'CREATE INDEX IF NOT EXISTS downloaded_album_tracks_track '
+    'ON downloaded_album_tracks (track_id)',
+)
+
+
+class StorageLibrary(object):
+    # History, mixtapes and downloads in xbmcswift2 storages (pickled dicts
+    # which are loaded and written as a whole) and the play history journal
+
+    def __init__(self, get_storage, history, entity_store):
+        self._get_storage = get_storage
+        self._history = history
+        self._entity_store = entity_store
+
+    # History
+
+    def add_played(self, track_id):
+        self.history.add(track_id)
+
+    def add_played_many(self, entries):
+        # entries: (track_id, timestamp) tuples, the last played last
+        self.history.add_many(entries)
+
+    def get_played_track_ids(self, offset=0, limit=None):
+        # The last played first
+        return _slice(self.history.get_track_ids(), offset, limit)
+
+    @property
+    def history(self):
+        if not self._history.exists():
+            # One-time migration of the history storage (ids or tracks)
+            storage = self._get_storage('history')
+            items = storage.get('items') or []
+            if items and isinstance(items[0], dict):
+                self._entity_store.put_many('tracks', items)
+                items = [t['id'] for t in items]
+            if items:
+                log('Moving %d history tracks into the journal' % len(items))
+            self._history.add_many((track_id, 0) for track_id in items)
+            storage.clear()
+            storage.sync()
+        return self._history
+
+    # Mixtapes
+
+    def get_mixtape_ids(self):
+        return self.mixtapes.keys()
+
+    def add_mixtape(self, mixtape_id):
+        mixtapes = self.mixtapes
+        if not mixtape_id in mixtapes:
+            mixtapes[mixtape_id] = []
+            mixtapes.sync()
+
+    def del_mixtape(self, mixtape_id):
+        mixtapes = self.mixtapes
+        if mixtape_id in mixtapes:
+            track_ids = mixtapes.pop(mixtape_id)
+            mixtapes.sync()
+            self._update_mixtape_index(track_ids, remove=mixtape_id)
+
+    def rename_mixtape(self, mixtape_id, new_mixtape_id):
+        # Returns False if there is already a mixtape named new_mixtape_id
+        mixtapes = self.mixtapes
+        if new_mixtape_id in mixtapes:
+            return False
+        track_ids = mixtapes.pop(mixtape_id)
+        mixtapes[new_mixtape_id] = track_ids
+        mixtapes.sync()
+        self._update_mixtape_index(
+            track_ids, remove=mixtape_id, add=new_mixtape_id
+        )
+        return True
+
+    def get_mixtape_track_ids(self, mixtape_id, offset=0, limit=None):
+        return _slice(self.mixtapes[mixtape_id], offset, limit)
+
+    def get_track_mixtape_ids(self, track_id):
+        return set(self.mixtape_index['tracks'].get(track_id, ()))
+
+    def add_mixtape_track(self, mixtape_id, track_id):
+        mixtapes = self.mixtapes
+        mixtapes[mixtape_id].append(track_id)
+        mixtapes.sync()
+        self._update_mixtape_index([track_id], add=mixtape_id)
+
+    def del_mixtape_track(self, mixtape_id, track_id):
+        mixtapes = self.mixtapes
+        mixtapes[mixtape_id] = [
+            t for t in mixtapes[mixtape_id]
+            if not t == track_id
+        ]
+        mixtapes.sync()
+        self._update_mixtape_index([track_id], remove=mixtape_id)
+
+    @property
+    def mixtapes(self):
+        mixtapes = self._get_storage('mixtapes')
+        for mixtape_id, tracks in mixtapes.items():
+            if tracks and isinstance(tracks[0], dict):
+                log('Moving mixtape tracks into the entity store')
+                self._entity_store.put_many('tracks', tracks)
+                mixtapes[mixtape_id] = [t['id'] for t in tracks]
+                mixtapes.sync()
+        return mixtapes
+
+    @property
+    def mixtape_index(self):
+        # track_id -> ids of the mixtapes containing the track
+        index = self._get_storage('mixtape_index')
+        if index.get('version') != MIXTAPE_INDEX_VERSION:
+            log('Building index of mixtape tracks')
+            tracks = {}
+            for mixtape_id, track_ids in self.mixtapes.iteritems():
+                for track_id in track_ids:
+                    tracks.setdefault(track_id, set()).add(mixtape_id)
+            index['tracks'] = tracks
+            index['version'] = MIXTAPE_INDEX_VERSION
+            index.sync()
+        return index
+
+    def _update_mixtape_index(self, track_ids, remove=None, add=None):
+        index = self._get_storage('mixtape_index')
+        if index.get('version') != MIXTAPE_INDEX_VERSION:
+            return  # built from the mixtapes on next use
+        tracks = index['tracks']
+        for track_id in track_ids:
+            mixtape_ids = tracks.setdefault(track_id, set())
+            mixtape_ids.discard(remove)
+            if add is not None:
+                mixtape_ids.add(add)
+            if not mixtape_ids:
+                del tracks[track_id]
+        index.sync()
+
+    def import_library(self, source):
+        # Replaces the contents with the ones of source (a SqliteLibrary),
+        # used when switching back from the SQLite backend
+        log('Copying the SQLite database into the library')
+        played_ids = source.get_played_track_ids()
+        self._history.replace(
+            (track_id, 0) for track_id in reversed(played_ids)
+        )
+        mixtapes = self._get_storage('mixtapes')
+        mixtapes.clear()
+        mixtapes.update(
+            (mixtape_id, source.get_mixtape_track_ids(mixtape_id))
+            for mixtape_id in source.get_mixtape_ids()
+        )
+        mixtapes.sync()
+        downloads = self._get_storage('downloaded_tracks')
+        downloads.clear()
+        downloads.update(
+            (t_id, {'file': source.get_downloaded_file(t_id)['file']})
+            for t_id in source.get_downloaded_track_ids()
+        )
+        downloads.sync()
+        downloads = self._get_storage('downloaded_albums')
+        downloads.clear()
+        for album_id in source.get_downloaded_album_ids():
+            downloads[album_id] = {'tracks': dict(
+                (t_id, {'file': source.get_downloaded_file(t_id)['file']})
+                for t_id in source.get_downloaded_album_track_ids(album_id)
+            )}
+        downloads.sync()
+        for name in ('mixtape_index', 'downloaded_index'):
+            index = self._get_storage(name)
+            index.clear()  # rebuilt on next use
+            index.sync()
+
+    def get_referenced_ids(self):
+        # kind -> ids of the entities the library refers to
+        track_ids = set(self.history.get_track_ids())
+        track_ids.update(self.mixtape_index['tracks'])
+        track_ids.update(self.download_index['tracks'])
+        return {
+            'tracks': track_ids,
+            'albums': set(self.downloaded_albums),
+        }
+
+    # Downloads
+
+    def add_downloaded_tracks(self, tracks):
+        # tracks: track_id -> {'file': ...}
+        downloads = self.downloaded_tracks
+        downloads.update(tracks)
+        downloads.sync()
+        self._add_to_index(
+            (t_id, t['file']) for t_id, t in tracks.iteritems()
+        )
+
+    def add_downloaded_albums(self, albums):
+        # albums: album_id -> {'tracks': {track_id: {'file': ...}}}
+        downloads = self.downloaded_albums
+        downloads.update(albums)
+        downloads.sync()
+        self._add_to_index(
+            (t_id, t['file']) for album in albums.itervalues()
+            for t_id, t in album['tracks'].iteritems()
+        )
+
+    def get_downloaded_track_ids(self, offset=0, limit=None):
+        return _slice(self.downloaded_tracks.keys(), offset, limit)
+
+    def get_downloaded_album_ids(self, offset=0, limit=None):
+        return _slice(self.downloaded_albums.keys(), offset, limit)
+
+    def get_downloaded_album_track_ids(self, album_id):
+        return self.downloaded_albums[album_id]['tracks'].keys()
+
+    def get_downloaded_file(self, track_id):
+        # Returns {'file': ..., 'verified': ...} or None
+        entry = self.download_index['tracks'].get(track_id)
+        return dict(entry) if entry else None
+
+    def set_download_verified(self, track_id, verified):
+        index = self.download_index
+        index['tracks'][track_id]['verified'] = verified
+        index.sync()
+
+    @property
+    def downloaded_tracks(self):
+        downloads = self._get_storage('downloaded_tracks')
+        # no len()/bool() on storages, xbmcswift2's _Storage.__len__ is broken
+        items = downloads.items()
+        if items and 'data' in items[0][1]:
+            log('Moving downloaded tracks into the entity store')
+            normalize_downloaded_tracks(downloads, self._entity_store)
+            downloads.sync()
+        return downloads
+
+    @property
+    def downloaded_albums(self):
+        downloads = self._get_storage('downloaded_albums')
+        # no len()/bool() on storages, xbmcswift2's _Storage.__len__ is broken
+        items = downloads.items()
+        if items and 'data' in items[0][1]:
+            log('Moving downloaded albums into the entity store')
+            normalize_downloaded_albums(downloads, self._entity_store)
+            downloads.sync()
+        return downloads
+
+    @property
+    def download_index(self):
+        # track_id -> local file of all downloaded tracks and album tracks
+        index = self._get_storage('downloaded_index')
+        if index.get('version') != DOWNLOAD_INDEX_VERSION:
+            log('Building index of downloaded tracks')
+            tracks = dict(
+                (t_id, {'file': t['file'], 'verified': 0})
+                for t_id, t in self.downloaded_tracks.iteritems()
+            )
+            for album in self.downloaded_albums.itervalues():
+                tracks.update(
+                    (t_id, {'file': t['file'], 'verified': 0})
+                    for t_id, t in album['tracks'].iteritems()
+                )
+            index['tracks'] = tracks
+            index['version'] = DOWNLOAD_INDEX_VERSION
+            index.sync()
+        return index
+
+    def _add_to_index(self, files):
+        index = self._get_storage('downloaded_index')
+        if index.get('version') == DOWNLOAD_INDEX_VERSION:
+            index['tracks'].update(
+                (t_id, {'file': f, 'verified': time.time()})
+                for t_id, f in files
+            )
+            index.sync()
+
+
+class SqliteLibrary(object):
+    # History, mixtapes and downloads in indexed SQLite tables, every change
+    # is a single-row transaction. On first use the contents of the source
+    # library (a StorageLibrary) are copied over once.
+
+    def __init__(self, db_path, history_limit=0, source=None):
+        self.db_path = db_path
+        self.history_limit = int(history_limit or 0)
+        self._source = source
+        self._lock = threading.RLock()
+        self._conn = None
+
+    # History
+
+    def add_played(self, track_id):
+        self.add_played_many([(track_id, time.time())])
+
+    def add_played_many(self, entries):
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO history (track_id, played) '
+                'VALUES (?, ?)', entries
+            )
+            if self.history_limit:
+                self._db.execute(
+                    'DELETE FROM history WHERE rowid <= ('
+                    '    SELECT rowid FROM history ORDER BY rowid DESC '
+                    '    LIMIT 1 OFFSET ?'
+                    ')', (self.history_limit, )
+                )
+            self._db.commit()
+
+    def get_played_track_ids(self, offset=0, limit=None):
+        return self._column(
+            'SELECT track_id FROM history ORDER BY rowid DESC',
+            offset=offset, limit=limit
+        )
+
+    # Mixtapes
+
+    def get_mixtape_ids(self):
+        return self._column('SELECT name FROM mixtapes ORDER BY id')
+
+    def add_mixtape(self, mixtape_id):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR IGNORE INTO mixtapes (name) VALUES (?)',
+                (mixtape_id, )
+            )
+            self._db.commit()
+
+    def del_mixtape(self, mixtape_id):
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM mixtape_tracks WHERE mixtape_id = '
+                '(SELECT id FROM mixtapes WHERE name = ?)', (mixtape_id, )
+            )
+            self._db.execute(
+                'DELETE FROM mixtapes WHERE name = ?', (mixtape_id, )
+            )
+            self._db.commit()
+
+    def rename_mixtape(self, mixtape_id, new_mixtape_id):
+        with self._lock:
+            try:
+                self._db.execute(
+                    'UPDATE mixtapes SET name = ? WHERE name = ?',
+                    (new_mixtape_id, mixtape_id)
+                )
+            except sqlite3.IntegrityError:
+                return False  # the name is taken by another mixtape
+            self._db.commit()
+        return True
+
+    def get_mixtape_track_ids(self, mixtape_id, offset=0, limit=None):
+        return self._column(
+            'SELECT t.track_id FROM mixtape_tracks t '
+            'JOIN mixtapes m ON m.id = t.mixtape_id '
+            'WHERE m.name = ? ORDER BY t.position', (mixtape_id, ),
+            offset=offset, limit=limit
+        )
+
+    def get_track_mixtape_ids(self, track_id):
+        return set(self._column(
+            'SELECT m.name FROM mixtape_tracks t '
+            'JOIN mixtapes m ON m.id = t.mixtape_id '
+            'WHERE t.track_id = ?', (track_id, )
+        ))
+
+    def add_mixtape_track(self, mixtape_id, track_id):
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO mixtape_tracks (mixtape_id, position, track_id) '
+                'SELECT m.id, COALESCE(MAX(t.position), 0) + 1, ? '
+                'FROM mixtapes m '
+                'LEFT JOIN mixtape_tracks t ON t.mixtape_id = m.id '
+                'WHERE m.name = ? GROUP BY m.id', (track_id, mixtape_id)
+            )
+            self._db.commit()
+
+    def del_mixtape_track(self, mixtape_id, track_id):
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM mixtape_tracks WHERE track_id = ? AND '
+                'mixtape_id = (SELECT id FROM mixtapes WHERE name = ?)',
+                (track_id, mixtape_id)
+            )
+            self._db.commit()
+
+    # Downloads
+
+    def add_downloaded_tracks(self, tracks):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO downloaded_tracks '
+                '(track_id, file, verified) VALUES (?, ?, ?)',
+                ((t_id, t['file'], now) for t_id, t in tracks.iteritems())
+            )
+            self._db.commit()
+
+    def add_downloaded_albums(self, albums):
+        now = time.time()
+        with self._lock:
+            for album_id, album in albums.iteritems():
+                self._db.execute(
+                    'INSERT OR IGNORE INTO downloaded_albums (album_id) '
+                    'VALUES (?)', (album_id, )
+                )
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO downloaded_album_tracks '
+                    '(album_id, track_id, file, verified) VALUES (?, ?, ?, ?)',
+                    ((album_id, t_id, t['file'], now)
+                     for t_id, t in album['tracks'].iteritems())
+                )
+            self._db.commit()
+
+    def get_downloaded_track_ids(self, offset=0, limit=None):
+        return self._column(
+            'SELECT track_id FROM downloaded_tracks ORDER BY rowid',
+            offset=offset, limit=limit
+        )
+
+    def get_downloaded_album_ids(self, offset=0, limit=None):
+        return self._column(
+            'SELECT album_id FROM downloaded_albums ORDER BY rowid',
+            offset=offset, limit=limit
+        )
+
+    def get_downloaded_album_track_ids(self, album_id):
+        return self._column(
+            'SELECT track_id FROM downloaded_album_tracks '
+            'WHERE album_id = ? ORDER BY rowid', (album_id, )
+        )
+
+    def get_downloaded_file(self, track_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT file, verified FROM downloaded_tracks '
+                'WHERE track_id = ? '
+                'UNION ALL '
+                'SELECT file, verified FROM downloaded_album_tracks '
+                'WHERE track_id = ? LIMIT 1', (track_id, track_id)
+            ).fetchone()
+        if row:
+            return {'file': row[0], 'verified': row[1]}
+
+    def set_download_verified(self, track_id, verified):
+        with self._lock:
+            for table in ('downloaded_tracks', 'downloaded_album_tracks'):
+                self._db.execute(
+                    'UPDATE %s SET verified = ? WHERE track_id = ?' % table,
+                    (verified, track_id)
+                )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get_referenced_ids(self):
+        return {
+            'tracks': set(self._column(
+                'SELECT track_id FROM history '
+                'UNION SELECT track_id FROM mixtape_tracks '
+                'UNION SELECT track_id FROM downloaded_tracks '
+                'UNION SELECT track_id FROM downloaded_album_tracks'
+            )),
+            'albums': set(self._column(
+                'SELECT album_id FROM downloaded_albums'
+            )),
+        }
+
+    def _column(self, query, args=(), offset=0, limit=None):
+        if offset or limit is not None:
+            # a negative limit means no limit in SQLite
+            query += ' LIMIT ? OFFSET ?'
+            args = tuple(args) + (-1 if limit is None else limit, offset)
+        with self._lock:
+            return [row[0] for row in self._db.execute(query, args)]
+
+    def _migrate(self, conn, source):
+        log('Copying the library into the SQLite database')
+        played_ids = list(reversed(source.get_played_track_ids()))
+        conn.executemany(
+            'INSERT OR REPLACE INTO history (track_id, played) VALUES (?, 0)',
+            ((track_id, ) for track_id in played_ids)
+        )
+        for mixtape_id in source.get_mixtape_ids():
+            cursor = conn.execute(
+                'INSERT INTO mixtapes (name) VALUES (?)', (mixtape_id, )
+            )
+            conn.executemany(
+                'INSERT INTO mixtape_tracks (mixtape_id, position, track_id) '
+                'VALUES (?, ?, ?)',
+                ((cursor.lastrowid, position, track_id) for position, track_id
+                 in enumerate(source.get_mixtape_track_ids(mixtape_id), 1))
+            )
+        conn.executemany(
+            'INSERT INTO downloaded_tracks (track_id, file) VALUES (?, ?)',
+            ((t_id, t['file'])
+             for t_id, t in source.downloaded_tracks.iteritems())
+        )
+        for album_id, album in source.downloaded_albums.iteritems():
+            conn.execute(
+                'INSERT INTO downloaded_albums (album_id) VALUES (?)',
+                (album_id, )
+            )
+            conn.executemany(
+                'INSERT INTO downloaded_album_tracks '
+                '(album_id, track_id, file) VALUES (?, ?, ?)',
+                ((album_id, t_id, t['file'])
+                 for t_id, t in album['tracks'].iteritems())
+            )
+
+    @property
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=10,
+                check_same_thread=False
+            )
+            # ids and mixtape names are byte strings, like in the storages
+            conn.text_factory = str
+            for statement in SCHEMA:
+                conn.execute(statement)
+            migrated = conn.execute(
+                'SELECT value FROM meta WHERE name = ?', ('migrated', )
+            ).fetchone()
+            if not migrated:
+                try:
+                    if self._source is not None:
+                        self._migrate(conn, self._source)
+                    conn.execute(
+                        'INSERT INTO meta (name, value) VALUES (?, ?)',
+                        ('migrated', str(time.time()))
+                    )
+                except:
+                    conn.rollback()
+                    conn.close()
+                    raise
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+
+def _slice(items, offset, limit):
+    if limit is None:
+        return list(items[offset:])
+    return list(items[offset:offset + limit])
+
+
+def normalize_downloaded_tracks(tracks, entity_store):
+    # The downloader returns the track data, only the file is kept
+    entity_store.put_many(
+        'tracks',
+        [t.pop('data') for t in tracks.itervalues() if 'data' in t]
+    )
+    return tracks
+
+
+def normalize_downloaded_albums(albums, entity_store):
+    entity_store.put_many(
+        'albums',
+        [a.pop('data') for a in albums.itervalues() if 'data' in a]
+    )
+    for album in albums.itervalues():
+        normalize_downloaded_tracks(album['tracks'], entity_store)
+    return albums
+
+
+def log(msg):
+    print u'[Library]: %s' % repr(msg)
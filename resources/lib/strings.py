@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+class StringTable(object):
+    # Localized strings of the ids in strings ({string_id: number}), each
+    # one is looked up once and served from a dict afterwards, like
+    # xbmcswift2's Plugin.get_string. For the downloader and the service,
+    # which call getLocalizedString directly. Call invalidate() after the
+    # language changed.
+
+    def __init__(self, strings, get_string):
+        self.strings = strings
+        self.get_string = get_string
+        self._table = {}
+
+    def get(self, string_id):
+        # Returns None for unknown string ids
+        string = self._table.get(string_id)
+        if string is None and string_id in self.strings:
+            string = self.get_string(self.strings[string_id])
+            self._table[string_id] = string
+        return string
+
+    def invalidate(self):
+        self._table = {}
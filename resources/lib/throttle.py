@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+import threading
+import time
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS buckets ('
+    '    name TEXT PRIMARY KEY,'
+    '    tokens REAL NOT NULL,'
+    '    updated REAL NOT NULL'
+    ')',
+)
+
+
+class TokenBucket(object):
+    # Allows bursts of up to burst calls, refilled with rate calls per second
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a token is available, returns the seconds waited
+        waited = 0
+        while True:
+            delay = self._take()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def _take(self):
+        # Takes a token, else returns the seconds until one is available
+        with self._lock:
+            self._tokens, self._updated, delay = self._refill(
+                self._tokens, self._updated
+            )
+        return delay
+
+    def _refill(self, tokens, updated):
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0
+        return tokens, now, (1 - tokens) / self.rate
+
+
+class SharedTokenBucket(TokenBucket):
+    # A TokenBucket kept in a SQLite database, so all plugin invocations
+    # and the service draw from the same bucket
+
+    def __init__(self, db_path, rate, burst, name='api'):
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.db_path = db_path
+        self.name = name
+        self._conn = None
+
+    def _take(self):
+        with self._lock:
+            try:
+                return self._take_shared()
+            except sqlite3.Error, e:
+                # better not throttled than not requesting at all
+                log('Shared bucket failed: %s' % e)
+                return 0
+
+    def _take_shared(self):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')  # locks out the other invocations
+        try:
+            row = db.execute(
+                'SELECT tokens, updated FROM buckets WHERE name = ?',
+                (self.name, )
+            ).fetchone()
+            tokens, updated, delay = self._refill(
+                *(row or (self.burst, time.time()))
+            )
+            db.execute(
+                'INSERT OR REPLACE INTO buckets (name, tokens, updated) '
+                'VALUES (?, ?, ?)', (self.name, tokens, updated)
+            )
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        return delay
+
+    @property
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.db_path,
+                timeout=10,
+                check_same_thread=False,
+                isolation_level=None  # transactions are explicit
+            )
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+        return self._conn
+
+
+class SingleFlight(object):
+    # Identical calls running at the same time in this process (e.g. in the
+    # prefetch, revalidation and gather threads) share one execution
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        # Returns (result, shared), shared is True if the result was
+        # produced by a call which was already in flight
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def log(msg):
+    print u'[Throttle]: %s' % repr(msg)
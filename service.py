@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+
+import xbmc
+import xbmcaddon
+import xbmcgui
+from resources.lib.api import JamendoApi, RATE_LIMIT, RATE_BURST
+from resources.lib.cache import StreamUrlCache
+from resources.lib.downloader import JamendoDownloader, DownloadAborted, \
+    strings as downloader_strings
+from resources.lib.jobs import DownloadQueue
+from resources.lib.strings import StringTable
+from resources.lib.throttle import SharedTokenBucket
+
+STRINGS = {
+    'progress_head': 30080,
+    'download_suceeded': 30070,
+}
+AUDIO_FORMATS = ('mp3', 'ogg', 'flac')
+POLL_INTERVAL = 5  # seconds
+
+addon = xbmcaddon.Addon()
+strings = StringTable(STRINGS, addon.getLocalizedString)
+monitor = xbmc.Monitor()
+
+
+class Player(xbmc.Player):
+    # Kodi only delivers the callbacks while the service waits (in
+    # waitForAbort or sleep), not while a job is processed, so a started
+    # playback is also detected by poll()
+
+    def __init__(self):
+        xbmc.Player.__init__(self)
+        self.playing_file = None
+
+    def onPlayBackStarted(self):
+        # Whatever started, the resolved track didn't fail (any more)
+        xbmcgui.Window(10000).clearProperty('JamBMC.playing_track')
+        self.playing_file = self._get_playing_file()
+
+    def poll(self):
+        playing_file = self._get_playing_file()
+        if playing_file != self.playing_file:
+            self.playing_file = playing_file
+            if playing_file:
+                self.onPlayBackStarted()
+
+    def _get_playing_file(self):
+        try:
+            return self.getPlayingFile() if self.isPlaying() else None
+        except RuntimeError:
+            return None  # stopped meanwhile
+
+    def onPlayBackError(self):
+        # Only called by Kodi 18 and newer, older versions are handled by
+        # play_track (addon.py) when the track is played again.
+        # The cached stream url of the track may have become invalid
+        window = xbmcgui.Window(10000)
+        track_id = window.getProperty('JamBMC.playing_track')
+        if track_id:
+            log('Playback of track %s failed, dropping its stream url'
+                % track_id)
+            get_stream_url_cache().invalidate(track_id)
+            window.clearProperty('JamBMC.playing_track')
+
+
+player = Player()  # receives the playback callbacks while running
+
+
+class DownloadError(Exception):
+    pass
+
+
+def process_job(queue, job):
+    log('Processing job %(id)d: %(kind)s %(entity_id)s' % job)
+    try:
+        if job['kind'] == 'track':
+            result = download_track(job['entity_id'])
+        else:
+            result = download_album(job['entity_id'])
+    except DownloadAborted:
+        # the job stays running and is requeued by recover() on next start
+        log('Job %d interrupted by shutdown' % job['id'])
+        return
+    except Exception, e:
+        log('Job %d failed: %s' % (job['id'], e))
+        queue.fail(job['id'], unicode(e))
+        return
+    queue.finish(job['id'], result)
+    notify(_('download_suceeded'))
+
+
+def download_track(track_id):
+    downloader = get_downloader('tracks_download_path')
+    tracks = downloader.download_tracks(
+        [track_id],
+        get_audioformat(),
+        addon.getSetting('download_track_cover') == 'true'
+    )
+    if downloader.canceled:
+        raise DownloadAborted
+    if downloader.errors:
+        raise DownloadError(downloader.errors[0])
+    if not tracks:
+        raise DownloadError('Song could not be downloaded')
+    return tracks
+
+
+def download_album(album_id):
+    downloader = get_downloader('albums_download_path')
+    album = downloader.download_album(
+        album_id,
+        get_audioformat(),
+        addon.getSetting('download_album_cover') == 'true'
+    )
+    if downloader.canceled:
+        raise DownloadAborted
+    if downloader.errors:
+        raise DownloadError(downloader.errors[0])
+    if not any(a['tracks'] for a in album.itervalues()):
+        raise DownloadError('Album could not be downloaded')
+    return album
+
+
+def get_downloader(setting_name):
+    download_path = addon.getSetting(setting_name)
+    if not download_path:
+        raise DownloadError('No download path set')
+    api = JamendoApi(
+        client_id='de0f381a',
+        image_size=('big', 'medium', 'small')[
+            int(addon.getSetting('image_size') or 0)
+        ],
+        # downloads are background work, sharing the budget of the plugin's
+        rate_limiter=SharedTokenBucket(
+            os.path.join(get_profile_path(), 'throttle.db'),
+            RATE_LIMIT,
+            RATE_BURST
+        ),
+    )
+    return JamendoDownloader(
+        api,
+        download_path,
+        show_progress=False,
+        workers=addon.getSetting('download_workers') or 1,
+        host_connections=addon.getSetting('download_host_connections') or 2,
+        abort_requested=poll_abort_requested,
+    )
+
+
+def get_audioformat():
+    return AUDIO_FORMATS[int(addon.getSetting('download_format') or 0)]
+
+
+def get_queue():
+    return DownloadQueue(os.path.join(get_profile_path(), 'jobs.db'))
+
+
+def get_stream_url_cache():
+    return StreamUrlCache(os.path.join(get_profile_path(), 'streams.db'))
+
+
+def get_profile_path():
+    profile_path = xbmc.translatePath(addon.getAddonInfo('profile'))
+    if not os.path.isdir(profile_path):
+        os.makedirs(profile_path)
+    return profile_path
+
+
+def abort_requested():
+    if hasattr(monitor, 'abortRequested'):  # Kodi 14 and newer
+        return monitor.abortRequested()
+    return xbmc.abortRequested
+
+
+def poll_abort_requested():
+    # Called by the downloader while it downloads, every 200 ms
+    player.poll()
+    return abort_requested()
+
+
+def wait(seconds):
+    if hasattr(monitor, 'waitForAbort'):  # Kodi 14 and newer
+        monitor.waitForAbort(seconds)
+        return
+    for _ in xrange(seconds * 2):
+        if xbmc.abortRequested:
+            return
+        xbmc.sleep(500)
+
+
+def run():
+    language = xbmc.getLanguage()
+    queue = get_queue()
+    recovered = queue.recover()
+    if recovered:
+        log('Requeued %d interrupted jobs' % recovered)
+    while not abort_requested():
+        if xbmc.getLanguage() != language:
+            language = xbmc.getLanguage()
+            strings.invalidate()
+            downloader_strings.invalidate()
+        job = queue.claim_next()
+        if job:
+            process_job(queue, job)
+        else:
+            wait(POLL_INTERVAL)
+
+
+def notify(message):
+    xbmc.executebuiltin('Notification(%s, %s)' % (
+        _('progress_head').encode('utf-8'),
+        message.encode('utf-8')
+    ))
+
+
+def log(msg):
+    xbmc.log(u'[JamBMC Service]: %s' % msg.encode('utf8', 'ignore'))
+
+
+def _(string_id):
+    return strings.get(string_id)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,9 @@
+import sys
+
+import pytest
+
+
+def pytest_sessionstart(session):
+    # The addon runs on Kodi's Python 2 interpreter, and so do its tests
+    if sys.version_info[0] > 2:
+        pytest.exit('the tests need Python 2', returncode=0)
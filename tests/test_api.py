@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+from resources.lib.api import JamendoApi, MAX_IDS_PER_CALL
+from resources.lib.entities import EntityStore
+
+
+class FakeFetch(object):
+    # Answers like Jamendo: in its own order, unknown ids left out
+
+    def __init__(self, known_ids, fields=('musicinfo', )):
+        self.known_ids = set(known_ids)
+        self.fields = fields
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, ids, limit, **kwargs):
+        assert limit == len(ids) <= MAX_IDS_PER_CALL
+        with self._lock:
+            self.calls.append((list(ids), kwargs))
+        return [
+            dict(((field, 'x') for field in self.fields), id=int(i))
+            for i in sorted(ids, reverse=True) if i in self.known_ids
+        ]
+
+
+@pytest.fixture
+def api():
+    return JamendoApi(client_id='test')
+
+
+def test_results_follow_the_order_of_the_ids(api):
+    fetch = FakeFetch(['3', '1', '2'])
+    tracks = api._get_by_ids('tracks', fetch, [2, 3, 1], use_cache=False)
+    assert [t['id'] for t in tracks] == [2, 3, 1]
+
+
+def test_duplicate_and_unknown_ids(api):
+    fetch = FakeFetch(['1', '2'])
+    tracks = api._get_by_ids(
+        'tracks', fetch, ['2', '9', '2', '1'], use_cache=False
+    )
+    assert [t['id'] for t in tracks] == [2, 1]
+    assert fetch.calls == [(['2', '9', '1'], {})]
+
+
+def test_ids_are_requested_in_chunks(api):
+    ids = [str(i) for i in xrange(2 * MAX_IDS_PER_CALL + 1)]
+    fetch = FakeFetch(ids)
+    tracks = api._get_by_ids(
+        'tracks', fetch, ids, use_cache=False, audioformat='mp32'
+    )
+    assert [str(t['id']) for t in tracks] == ids
+    chunks = sorted(fetch.calls, key=lambda call: int(call[0][0]))
+    assert [len(chunk) for chunk, kwargs in chunks] == \
+        [MAX_IDS_PER_CALL, MAX_IDS_PER_CALL, 1]
+    assert all(kwargs == {'audioformat': 'mp32'} for _, kwargs in chunks)
+
+
+def test_no_request_without_ids(api):
+    fetch = FakeFetch([])
+    assert api._get_by_ids('tracks', fetch, [], use_cache=False) == []
+    assert fetch.calls == []
+
+
+def test_complete_stored_entities_are_not_requested(tmpdir):
+    entity_store = EntityStore(str(tmpdir.join('entities.db')))
+    entity_store.put_many('tracks', [
+        {'id': '1', 'musicinfo': 'stored'},
+        {'id': '2'},  # e.g. from a listing without musicinfo
+    ])
+    api = JamendoApi(client_id='test', entity_store=entity_store)
+    fetch = FakeFetch(['1', '2', '3'])
+    tracks = api._get_by_ids('tracks', fetch, ['3', '2', '1'], True)
+    assert [unicode(t['id']) for t in tracks] == ['3', '2', '1']
+    assert tracks[2]['musicinfo'] == 'stored'
+    assert fetch.calls == [(['3', '2'], {})]
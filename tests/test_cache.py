@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+from resources.lib.cache import ResponseCache, HOUR
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return ResponseCache(
+        str(tmpdir.join('cache.db')), max_bytes=10000, max_stale=HOUR
+    )
+
+
+def expire(cache, key, seconds_ago):
+    cache._db.execute(
+        'UPDATE entries SET expires = ? WHERE key = ?',
+        (time.time() - seconds_ago, key)
+    )
+    cache._db.commit()
+
+
+def keys(cache):
+    return set(row[0] for row in cache._db.execute('SELECT key FROM entries'))
+
+
+def test_get_set(cache):
+    assert cache.get('a') == (False, None, False)
+    cache.set('a', {'x': [1, 2]}, ttl=60)
+    assert cache.get('a') == (True, {'x': [1, 2]}, False)
+
+
+def test_make_key_ignores_kwargs_order():
+    assert ResponseCache.make_key('f', (1, ), {'a': 1, 'b': 2}) == \
+        ResponseCache.make_key('f', (1, ), {'b': 2, 'a': 1})
+
+
+def test_expired_entry_is_only_returned_stale(cache):
+    cache.set('a', 'value', ttl=60)
+    expire(cache, 'a', 60)
+    assert cache.get('a') == (False, None, False)
+    assert cache.get('a', allow_stale=True) == (True, 'value', True)
+
+
+def test_stale_entry_older_than_max_stale_is_a_miss(cache):
+    cache.set('a', 'value', ttl=60)
+    expire(cache, 'a', 2 * HOUR)
+    assert cache.get('a', allow_stale=True)[0] is False
+    found, value, stale = cache.get(
+        'a', allow_stale=True, max_stale=float('inf')
+    )
+    assert (found, value, stale) == (True, 'value', True)
+
+
+def test_expired_entries_are_kept_until_the_cache_is_full(cache):
+    cache.set('a', 'value', ttl=60, validators={'etag': 'x', 'hash': 'y'})
+    expire(cache, 'a', 30 * 24 * HOUR)
+    cache.set('b', 'other', ttl=60)
+    assert cache.get_expired('a') == (
+        'value', {'etag': 'x', 'hash': 'y'}
+    )
+
+
+def test_eviction_removes_least_recently_used_entries(cache):
+    cache.max_bytes = 3000
+    for key in 'abc':
+        cache.set(key, 'x' * 900, ttl=60)
+    cache.get('a')  # only in memory until the next write
+    cache.set('d', 'x' * 900, ttl=60)
+    assert keys(cache) == set('acd')
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_eviction_removes_expired_entries_first(cache):
+    cache.max_bytes = 3000
+    for key in 'abc':
+        cache.set(key, 'x' * 900, ttl=60)
+    expire(cache, 'c', 60)
+    cache.set('d', 'x' * 900, ttl=60)
+    assert keys(cache) == set('abd')
+
+
+def test_too_large_values_are_not_cached(cache):
+    cache.set('a', 'x' * 20000, ttl=60)
+    assert cache.get('a')[0] is False
+
+
+def test_refresh_extends_the_ttl(cache):
+    cache.set('a', 'value', ttl=60)
+    expire(cache, 'a', 60)
+    cache.refresh('a', ttl=60)
+    assert cache.get('a') == (True, 'value', False)
+    assert cache.get_stats()['revalidations'] == 1
+
+
+def test_stats_are_written_by_flush(cache, tmpdir):
+    cache.set('a', 'value', ttl=60)
+    cache.get('a')
+    cache.get('b')
+    other = ResponseCache(str(tmpdir.join('cache.db')), max_bytes=10000)
+    assert other.get_stats()['hits'] == 0
+    cache.flush()
+    stats = other.get_stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+
+def test_clear(cache):
+    cache.set('a', 'value', ttl=60)
+    cache.get('a')
+    cache.clear()
+    assert cache.get('a')[0] is False
+    assert cache.get_stats()['entries'] == 0
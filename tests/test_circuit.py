@@ -0,0 +1,97 @@
+import pytest
+
+from resources.lib.circuit import CircuitBreaker
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('circuit.json'))
+
+
+def open_circuit(breaker):
+    for _ in xrange(breaker.failure_threshold):
+        assert breaker.allow()
+        breaker.record_failure()
+
+
+def time_passes(breaker, seconds):
+    state = breaker.state
+    state['opened'] -= seconds
+    if state['probing']:
+        state['probing'] -= seconds
+
+
+def test_opens_after_failures_in_a_row(path):
+    breaker = CircuitBreaker(path, failure_threshold=3)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()  # not in a row any more
+    breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.get_stats()['state'] == 'closed'
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert breaker.get_stats()['state'] == 'open'
+
+
+def test_half_open_lets_one_trial_call_through(path):
+    breaker = CircuitBreaker(path, reset_timeout=60)
+    open_circuit(breaker)
+    time_passes(breaker, 61)
+    assert breaker.allow()
+    assert not breaker.allow()  # the trial call is running
+
+
+def test_successful_trial_call_closes(path):
+    breaker = CircuitBreaker(path, reset_timeout=60)
+    open_circuit(breaker)
+    time_passes(breaker, 61)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+    assert breaker.allow()
+    stats = breaker.get_stats()
+    assert (stats['state'], stats['failures']) == ('closed', 0)
+
+
+def test_failed_trial_call_stays_open(path):
+    breaker = CircuitBreaker(path, reset_timeout=60)
+    open_circuit(breaker)
+    time_passes(breaker, 61)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    time_passes(breaker, 61)
+    assert breaker.allow()
+
+
+def test_dead_trial_call_is_replaced(path):
+    breaker = CircuitBreaker(path, reset_timeout=60)
+    open_circuit(breaker)
+    time_passes(breaker, 61)
+    assert breaker.allow()
+    time_passes(breaker, 61)  # its invocation never reported back
+    assert breaker.allow()
+
+
+def test_state_is_shared_through_the_file(path):
+    open_circuit(CircuitBreaker(path))
+    breaker = CircuitBreaker(path)
+    assert not breaker.allow()
+    assert breaker.get_stats()['open_count'] == 1
+
+
+def test_broken_state_file_is_ignored(path):
+    with open(path, 'w') as f:
+        f.write('{broken')
+    assert CircuitBreaker(path).allow()
+
+
+def test_open_seconds(path):
+    breaker = CircuitBreaker(path, reset_timeout=60)
+    open_circuit(breaker)
+    time_passes(breaker, 61)
+    breaker.allow()
+    breaker.record_success()
+    assert 61 <= breaker.get_stats()['open_seconds'] < 70
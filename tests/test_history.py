@@ -0,0 +1,97 @@
+import os
+import threading
+
+import pytest
+
+from resources.lib import history
+from resources.lib.history import PlayHistory, PendingPlays
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('history.journal'))
+
+
+def line_count(path):
+    with open(path) as f:
+        return len(f.readlines())
+
+
+def test_replays_move_to_the_front(path):
+    journal = PlayHistory(path)
+    for track_id in ('1', '2', '1', '3'):
+        journal.add(track_id)
+    assert journal.get_track_ids() == ['3', '1', '2']
+    assert line_count(path) == 4  # appended only
+
+
+def test_limit(path):
+    journal = PlayHistory(path, limit=2)
+    journal.add_many([('1', 1), ('2', 2), ('3', 3)])
+    assert journal.get_track_ids() == ['3', '2']
+
+
+def test_cut_off_lines_are_skipped(path):
+    with open(path, 'w') as f:
+        f.write('1\t1\n2\t2\n3\t')
+    assert PlayHistory(path).get_track_ids() == ['2', '1']
+
+
+def test_compaction_after_append(path, monkeypatch):
+    monkeypatch.setattr(history, 'COMPACT_MIN_BYTES', 100)
+    journal = PlayHistory(path)
+    for i in xrange(40):
+        journal.add(str(i % 2), timestamp=i + 1)
+    assert line_count(path) < 40
+    assert journal.get_track_ids() == ['1', '0']
+
+
+def test_compaction_with_limit(path, monkeypatch):
+    monkeypatch.setattr(history, 'COMPACT_MIN_BYTES', 100)
+    journal = PlayHistory(path, limit=3)
+    for i in xrange(40):
+        journal.add(str(i), timestamp=i + 1)
+    assert line_count(path) < 40
+    assert journal.get_track_ids() == ['39', '38', '37']
+
+
+def test_reading_does_not_rewrite(path, monkeypatch):
+    monkeypatch.setattr(history, 'COMPACT_MIN_BYTES', 100)
+    with open(path, 'w') as f:
+        f.writelines('1\t%d\n' % i for i in xrange(1, 41))
+    PlayHistory(path).get_track_ids()
+    assert line_count(path) == 40
+
+
+def test_concurrent_appends_and_compactions(path, monkeypatch):
+    monkeypatch.setattr(history, 'COMPACT_MIN_BYTES', 200)
+
+    def play(n):
+        for i in xrange(100):
+            journal = PlayHistory(path)
+            journal.add('%d_%d' % (n, i))
+            if i % 20 == 0:
+                journal.compact()
+    threads = [threading.Thread(target=play, args=(n, )) for n in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(PlayHistory(path).get_track_ids())) == 400
+    assert os.listdir(os.path.dirname(path)) == ['history.journal']
+
+
+def test_replace(path):
+    journal = PlayHistory(path)
+    journal.add('1')
+    journal.replace([('2', 2), ('3', 3)])
+    assert journal.get_track_ids() == ['3', '2']
+
+
+def test_pending_plays(tmpdir):
+    pending = PendingPlays(str(tmpdir.join('history.pending')))
+    assert pending.take() == []
+    pending.add('1', timestamp=1)
+    pending.add_many([('2', 2)])
+    assert pending.take() == [('1', 1), ('2', 2)]
+    assert pending.take() == []
@@ -0,0 +1,85 @@
+import pytest
+
+from resources.lib import jobs
+from resources.lib.jobs import DownloadQueue, QUEUED, RUNNING, DONE, FAILED
+
+
+@pytest.fixture
+def queue(tmpdir):
+    return DownloadQueue(str(tmpdir.join('jobs.db')))
+
+
+def states(queue):
+    return [job['state'] for job in queue.get_jobs()]
+
+
+def test_enqueue_claim_finish_collect(queue):
+    assert queue.enqueue('track', '5')
+    assert not queue.enqueue('track', '5')  # already waiting
+    job = queue.claim_next()
+    assert (job['kind'], job['entity_id'], job['state']) == \
+        ('track', '5', RUNNING)
+    assert queue.claim_next() is None
+    queue.finish(job['id'], {'5': {'file': '/music/5.mp3'}})
+    assert queue.collect_results() == [
+        ('track', {'5': {'file': '/music/5.mp3'}})
+    ]
+    assert queue.collect_results() == []
+
+
+def test_failed_attempts_are_retried_with_backoff(queue, monkeypatch):
+    monkeypatch.setattr(jobs, 'MAX_ATTEMPTS', 2)
+    queue.enqueue('album', '7')
+    job = queue.claim_next()
+    queue.fail(job['id'], u'HTTP 500')
+    assert states(queue) == [QUEUED]
+    assert queue.claim_next() is None  # not due yet
+    queue._set(job['id'], next_try=0)
+    job = queue.claim_next()
+    queue.fail(job['id'], u'HTTP 500')
+    assert states(queue) == [FAILED]
+    assert queue.get_jobs()[0]['error'] == u'HTTP 500'
+
+
+def test_only_failed_jobs_are_retried(queue, monkeypatch):
+    monkeypatch.setattr(jobs, 'MAX_ATTEMPTS', 1)
+    queue.enqueue('track', '5')
+    job = queue.claim_next()
+    assert not queue.retry(job['id'])
+    assert states(queue) == [RUNNING]
+    queue.fail(job['id'], u'disk full')
+    assert queue.retry(job['id'])
+    assert states(queue) == [QUEUED]
+    assert queue.claim_next()['attempts'] == 1
+
+
+def test_retried_job_is_collected_again(queue):
+    queue.enqueue('track', '5')
+    job = queue.claim_next()
+    queue.finish(job['id'], {'5': {'file': '/music/5.mp3'}})
+    queue.collect_results()
+    queue._set(job['id'], state=FAILED)  # e.g. the file was lost
+    queue.retry(job['id'])
+    job = queue.claim_next()
+    queue.finish(job['id'], {'5': {'file': '/music/new.mp3'}})
+    assert queue.collect_results() == [
+        ('track', {'5': {'file': '/music/new.mp3'}})
+    ]
+
+
+def test_recover_requeues_running_jobs(queue):
+    queue.enqueue('track', '5')
+    queue.claim_next()
+    assert queue.recover() == 1
+    assert states(queue) == [QUEUED]
+
+
+def test_collected_jobs_are_removed_later(queue, monkeypatch):
+    queue.enqueue('track', '5')
+    job = queue.claim_next()
+    queue.finish(job['id'], {})
+    queue.collect_results()
+    assert states(queue) == [DONE]
+    monkeypatch.setattr(jobs, 'KEEP_DONE', -1)
+    queue.collect_results()
+    assert states(queue) == []
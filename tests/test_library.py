@@ -0,0 +1,112 @@
+import pytest
+from xbmcswift2.storage import _Storage
+
+from resources.lib.entities import EntityStore
+from resources.lib.history import PlayHistory
+from resources.lib.library import StorageLibrary, SqliteLibrary
+
+
+@pytest.fixture
+def storages(tmpdir):
+    # Real xbmcswift2 storages, as returned by plugin.get_storage()
+    opened = {}
+
+    def get_storage(name):
+        if name not in opened:
+            opened[name] = _Storage(str(tmpdir.join(name)))
+        return opened[name]
+    return get_storage
+
+
+@pytest.fixture
+def entity_store(tmpdir):
+    return EntityStore(str(tmpdir.join('entities.db')))
+
+
+@pytest.fixture
+def library(tmpdir, storages, entity_store):
+    return StorageLibrary(
+        storages, PlayHistory(str(tmpdir.join('history.journal'))),
+        entity_store
+    )
+
+
+def test_empty_downloads(library):
+    assert library.get_downloaded_file('5') is None
+    assert library.get_downloaded_track_ids() == []
+    assert library.get_downloaded_album_ids() == []
+    assert library.get_referenced_ids() == {
+        'tracks': set(),
+        'albums': set(),
+    }
+
+
+def test_downloaded_tracks(library):
+    library.add_downloaded_tracks({'5': {'file': '/music/5.mp3'}})
+    assert library.get_downloaded_track_ids() == ['5']
+    assert library.get_downloaded_file('5')['file'] == '/music/5.mp3'
+
+
+def test_downloaded_albums(library):
+    library.add_downloaded_albums({'7': {'tracks': {
+        '70': {'file': '/music/7/70.mp3'},
+        '71': {'file': '/music/7/71.mp3'},
+    }}})
+    assert library.get_downloaded_album_ids() == ['7']
+    assert sorted(library.get_downloaded_album_track_ids('7')) == \
+        ['70', '71']
+    assert library.get_downloaded_file('71')['file'] == '/music/7/71.mp3'
+    assert library.get_referenced_ids()['albums'] == set(['7'])
+
+
+def test_downloads_with_data_move_into_the_entity_store(
+        library, storages, entity_store):
+    # as stored by versions before the entity store
+    storages('downloaded_tracks')['5'] = {
+        'file': '/music/5.mp3',
+        'data': {'id': '5', 'name': 'Track'},
+    }
+    storages('downloaded_albums')['7'] = {
+        'data': {'id': '7', 'name': 'Album'},
+        'tracks': {'70': {
+            'file': '/music/7/70.mp3',
+            'data': {'id': '70', 'name': 'Album Track'},
+        }},
+    }
+    assert library.get_downloaded_file('5')['file'] == '/music/5.mp3'
+    assert library.get_downloaded_file('70')['file'] == '/music/7/70.mp3'
+    assert storages('downloaded_tracks')['5'] == {'file': '/music/5.mp3'}
+    assert entity_store.get('tracks', '5')['name'] == 'Track'
+    assert entity_store.get('tracks', '70')['name'] == 'Album Track'
+    assert entity_store.get('albums', '7')['name'] == 'Album'
+
+
+def test_history(library):
+    for track_id in ('1', '2', '1', '3'):
+        library.add_played(track_id)
+    assert library.get_played_track_ids() == ['3', '1', '2']
+    assert library.get_played_track_ids(offset=1, limit=1) == ['1']
+
+
+def test_mixtapes(library):
+    library.add_mixtape('mix')
+    library.add_mixtape_track('mix', '1')
+    library.add_mixtape_track('mix', '2')
+    assert library.rename_mixtape('mix', 'tape') is True
+    library.add_mixtape('other')
+    assert library.rename_mixtape('other', 'tape') is False
+    assert library.get_mixtape_track_ids('tape') == ['1', '2']
+    assert library.get_track_mixtape_ids('2') == set(['tape'])
+
+
+def test_import_library(tmpdir, library):
+    source = SqliteLibrary(str(tmpdir.join('library.db')))
+    source.add_played('1')
+    source.add_played('2')
+    source.add_mixtape('mix')
+    source.add_mixtape_track('mix', '3')
+    source.add_downloaded_tracks({'5': {'file': '/music/5.mp3'}})
+    library.import_library(source)
+    assert library.get_played_track_ids() == ['2', '1']
+    assert library.get_mixtape_track_ids('mix') == ['3']
+    assert library.get_downloaded_file('5')['file'] == '/music/5.mp3'
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2013 Tristan Fischer (sphere@dersphere.de)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Times formatting a page of 100 tracks and albums into list items, like
+# a plugin invocation does (the url templates are cleared before every
+# page). With a git revision, the addon.py of that revision is timed too
+# and has to produce the same items. Runs outside of Kodi with the CLI
+# mode of xbmcswift2, from the root of the addon:
+#
+#   python tools/bench_format_items.py [<revision>]
+
+import imp
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from xml.etree import ElementTree
+
+import xbmcswift2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = 200
+RUNS = 5
+
+TRACKS = [{
+    'id': str(1000 + i),
+    'name': u'Track %d' % i,
+    'artist_id': str(10 + i),
+    'album_id': str(200 + i),
+    'artist_name': u'Artist',
+    'album_name': u'Album',
+    'duration': 200,
+    'releasedate': '2012-01-01',
+    'album_image': 'http://example.com/cover.jpg',
+    'musicinfo': {
+        'lang': 'en',
+        'tags': {
+            'genres': ['rock'],
+            'instruments': ['guitar'],
+            'vartags': ['calm'],
+        },
+    },
+} for i in xrange(100)]
+ALBUMS = [{
+    'id': str(500 + i),
+    'name': u'Album %d' % i,
+    'artist_id': str(10 + i),
+    'artist_name': u'Artist',
+    'releasedate': '2012-01-01',
+    'image': 'http://example.com/cover.jpg',
+} for i in xrange(100)]
+
+
+def setup_cli_mode():
+    # The addon imports the xbmc modules directly, xbmcswift2 mocks them
+    for name in ('xbmc', 'xbmcgui', 'xbmcaddon', 'xbmcplugin', 'xbmcvfs'):
+        sys.modules[name] = getattr(xbmcswift2, name)
+    settings = ElementTree.parse(
+        os.path.join(ROOT, 'resources', 'settings.xml')
+    )
+    for setting in settings.iter('setting'):
+        if setting.get('id'):
+            os.environ.setdefault(
+                'XBMCSWIFT2_%s' % setting.get('id').upper(),
+                setting.get('default', '')
+            )
+    strings = dict(
+        (int(string.get('id')), string.text or u'')
+        for string in ElementTree.parse(os.path.join(
+            ROOT, 'resources', 'language', 'English', 'strings.xml'
+        )).iter('string')
+    )
+    profile = 'special://profile/addon_data/%s/' % os.path.basename(
+        tempfile.mkdtemp()
+    )
+    addon_class = xbmcswift2.xbmcaddon.Addon
+    get_addon_info = addon_class.getAddonInfo
+    addon_class.getAddonInfo = lambda self, info_id: (
+        profile if info_id == 'profile' else get_addon_info(self, info_id)
+    )
+    addon_class.getLocalizedString = lambda self, string_id: (
+        strings[int(string_id)]
+    )
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+
+def load_addon(name, source):
+    module = imp.new_module(name)
+    module.__file__ = os.path.join(ROOT, 'addon.py')
+    exec compile(source, module.__file__, 'exec') in module.__dict__
+    module.plugin._request = xbmcswift2.Request('plugin://%s/' % (
+        module.plugin.id
+    ), '0')
+    module.plugin.request.view_params = {}
+    return module
+
+
+def format_page(addon, func, items):
+    # A new invocation starts without templates
+    if hasattr(addon, 'templates'):
+        addon.templates.clear()
+    return getattr(addon, func)(items)
+
+
+def time_page(addon, func, items):
+    best = None
+    for _ in xrange(RUNS):
+        start = time.time()
+        for _ in xrange(PAGES):
+            format_page(addon, func, items)
+        elapsed = (time.time() - start) / PAGES
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    setup_cli_mode()
+    addons = [('working tree', load_addon('addon', open('addon.py').read()))]
+    if len(sys.argv) > 1:
+        revision = sys.argv[1]
+        source = subprocess.check_output(
+            ['git', 'show', '%s:addon.py' % revision]
+        )
+        addons.append((revision, load_addon('addon_%s' % revision, source)))
+    for func, items in (('format_tracks', TRACKS),
+                        ('format_albums', ALBUMS)):
+        for label, addon in addons:
+            print '%-15s %-15s %.2f ms/page' % (
+                func, label, time_page(addon, func, items)
+            )
+        results = [format_page(addon, func, items) for _, addon in addons]
+        if results.count(results[0]) != len(results):
+            print '%s: the items differ' % func
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()